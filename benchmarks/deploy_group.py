@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""Deploy synthetic groups against a fake CloudFormation with artificial latency.
+
+Wall-clock time should follow the length of the dependency chain (the critical
+path), not the number of stacks in the group.
+
+    PYTHONPATH=. python3 benchmarks/deploy_group.py
+"""
+
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+import time
+from unittest import mock
+
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_cloudformation import FakeCloudFormation
+from stacklift.cfn_deploy import CloudFormationDeployer
+from stacklift.deploy_group import DeployGroup
+from stacklift import aws_executor, rate_governor
+from stacklift.aws_clients import AwsClients
+
+LATENCY = 0.05
+CHANGE_SET_DURATION = 0.2
+STACK_DURATION = 0.5
+
+SCENARIOS = [
+    # (name, width, depth, max_parallel, redeploy)
+    ("independent-10", 10, 1, None, False),
+    ("independent-40", 40, 1, None, False),
+    ("chain-4", 1, 4, None, False),
+    ("layers-10x4", 10, 4, None, False),
+    ("layers-10x4", 10, 4, 10, False),
+    ("unchanged-10x4", 10, 4, None, True),
+]
+
+
+def write_group(work_dir, width, depth):
+    templates = []
+    stacks = {}
+    for level in range(depth):
+        for i in range(width):
+            name = "stack-{}-{}".format(level, i)
+            template = {"Name": name, "Filename": "template.yml"}
+            if level > 0:
+                template["Depends"] = ["stack-{}-{}".format(level - 1, i)]
+            templates.append(template)
+            stacks[name] = {"StackName": name}
+
+    with open(os.path.join(work_dir, "template.yml"), "w") as f:
+        yaml.safe_dump({"Resources": {"Topic": {"Type": "AWS::SNS::Topic"}}}, f)
+    with open(os.path.join(work_dir, "templates.yml"), "w") as f:
+        yaml.safe_dump({"Groups": {"bench": {"Templates": templates}}}, f)
+
+    config_file = os.path.join(work_dir, "config.yml")
+    with open(config_file, "w") as f:
+        yaml.safe_dump({"Global": {"ModuleDir": ".", "Templates": "templates.yml"},
+                        "Common": {"Region": "us-east-1"},
+                        "Stacks": stacks}, f)
+    return config_file
+
+
+def run_scenario(width, depth, max_parallel, redeploy):
+    fake = FakeCloudFormation(latency=LATENCY,
+                              change_set_duration=CHANGE_SET_DURATION,
+                              stack_duration=STACK_DURATION)
+    with tempfile.TemporaryDirectory() as work_dir:
+        config_file = write_group(work_dir, width, depth)
+        os.environ["STACKLIFT_CACHE_DIR"] = os.path.join(work_dir, "cache")
+        with mock.patch.object(AwsClients, "get_client", return_value=fake):
+            if redeploy:
+                deploy(config_file, max_parallel)
+                fake.call_count = 0
+            elapsed = deploy(config_file, max_parallel)
+    return elapsed, fake.call_count
+
+
+def deploy(config_file, max_parallel):
+    instance = DeployGroup(config_file=config_file, group_name="bench", max_parallel=max_parallel)
+    started = time.monotonic()
+    asyncio.get_event_loop().run_until_complete(instance.deploy_all())
+    return time.monotonic() - started
+
+
+def main():
+    logging.disable(logging.INFO)
+    CloudFormationDeployer.CHANGE_SET_POLL_INITIAL_DELAY = 0.05
+    CloudFormationDeployer.CHANGE_SET_POLL_MAX_DELAY = 0.2
+    CloudFormationDeployer.STACK_POLL_INITIAL_DELAY = 0.05
+    CloudFormationDeployer.STACK_POLL_MAX_DELAY = 0.2
+    aws_executor.set_max_workers(64)
+    # the fake never throttles, so measure the engine rather than the governor
+    rate_governor.OPERATION_RATES.clear()
+    rate_governor.DEFAULT_RATES["cloudformation"] = (1000.0, 1000)
+
+    print("{:<16} {:>6} {:>6} {:>12} {:>10} {:>8}".format(
+        "scenario", "stacks", "depth", "max-parallel", "wall (s)", "calls"))
+    for name, width, depth, max_parallel, redeploy in SCENARIOS:
+        elapsed, calls = run_scenario(width, depth, max_parallel, redeploy)
+        print("{:<16} {:>6} {:>6} {:>12} {:>10.2f} {:>8}".format(
+            name, width * depth, depth, max_parallel or "-", elapsed, calls))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+import itertools
+import threading
+import time
+import datetime
+from types import SimpleNamespace
+from botocore.exceptions import ClientError
+
+
+class FakeStack:
+    def __init__(self, stack_name, stack_id):
+        self.stack_name = stack_name
+        self.stack_id = stack_id
+        self.status = "REVIEW_IN_PROGRESS"
+        self.events = []
+        self.operation = None
+        self.finishes_at = None
+        self.creation_time = datetime.datetime.utcnow()
+        self.last_updated_time = None
+
+
+class FakeCloudFormation:
+    """In-memory CloudFormation stand-in whose every call blocks for `latency` seconds.
+
+    Change sets become available `change_set_duration` seconds after creation, and
+    stack operations complete `stack_duration` seconds after they start.
+    """
+
+    def __init__(self, latency, change_set_duration, stack_duration):
+        self.latency = latency
+        self.change_set_duration = change_set_duration
+        self.stack_duration = stack_duration
+        self.lock = threading.Lock()
+        self.stacks = {}
+        self.change_sets = {}
+        self.event_ids = itertools.count(1)
+        self.call_count = 0
+        self.meta = SimpleNamespace(region_name="us-east-1",
+                                    service_model=SimpleNamespace(service_name="cloudformation"))
+
+    def _call(self):
+        with self.lock:
+            self.call_count += 1
+        time.sleep(self.latency)
+
+    def _not_found(self, stack_name, operation_name):
+        return ClientError({"Error": {"Code": "ValidationError",
+                                      "Message": "Stack with id {0} does not exist".format(stack_name)}},
+                           operation_name)
+
+    def _add_event(self, stack, status):
+        stack.events.insert(0, {
+            "EventId": "event-{}".format(next(self.event_ids)),
+            "StackName": stack.stack_name,
+            "StackId": stack.stack_id,
+            "LogicalResourceId": stack.stack_name,
+            "PhysicalResourceId": stack.stack_id,
+            "ResourceType": "AWS::CloudFormation::Stack",
+            "ResourceStatus": status,
+            "Timestamp": datetime.datetime.utcnow()
+        })
+
+    def _find_stack(self, stack_name_or_id):
+        for stack in self.stacks.values():
+            if stack_name_or_id in (stack.stack_name, stack.stack_id):
+                self._refresh(stack)
+                return stack
+        return None
+
+    def _refresh(self, stack):
+        if stack.operation and time.monotonic() >= stack.finishes_at:
+            stack.status = "{}_COMPLETE".format(stack.operation)
+            stack.operation = None
+            stack.last_updated_time = datetime.datetime.utcnow()
+            self._add_event(stack, stack.status)
+
+    def _start_operation(self, stack, operation):
+        stack.operation = operation
+        stack.status = "{}_IN_PROGRESS".format(operation)
+        stack.finishes_at = time.monotonic() + self.stack_duration
+        self._add_event(stack, stack.status)
+
+    def describe_stacks(self, StackName=None, NextToken=None):
+        self._call()
+        with self.lock:
+            if StackName is None:
+                stacks = [self._find_stack(x) for x in list(self.stacks)]
+                return {"Stacks": [self._describe(x) for x in stacks if x.status != "DELETE_COMPLETE"]}
+
+            stack = self._find_stack(StackName)
+            if not stack or (stack.status == "DELETE_COMPLETE" and StackName == stack.stack_name):
+                raise self._not_found(StackName, "DescribeStacks")
+            return {"Stacks": [self._describe(stack)]}
+
+    def _describe(self, stack):
+        description = {"StackName": stack.stack_name,
+                       "StackId": stack.stack_id,
+                       "StackStatus": stack.status,
+                       "CreationTime": stack.creation_time}
+        if stack.last_updated_time:
+            description["LastUpdatedTime"] = stack.last_updated_time
+        return description
+
+    def describe_stack_events(self, StackName, NextToken=None):
+        self._call()
+        with self.lock:
+            stack = self._find_stack(StackName)
+            if not stack:
+                raise self._not_found(StackName, "DescribeStackEvents")
+            return {"StackEvents": list(stack.events)}
+
+    def create_change_set(self, StackName, ChangeSetName, ChangeSetType, **kwargs):
+        self._call()
+        with self.lock:
+            stack = self._find_stack(StackName)
+            if not stack:
+                stack = FakeStack(StackName, "arn:aws:cloudformation:fake:stack/{}/1".format(StackName))
+                self.stacks[StackName] = stack
+            self.change_sets[(stack.stack_id, ChangeSetName)] = {
+                "Type": ChangeSetType,
+                "ReadyAt": time.monotonic() + self.change_set_duration,
+                "Executed": False
+            }
+            return {"StackId": stack.stack_id, "Id": ChangeSetName}
+
+    def _change_set(self, stack_name_or_id, change_set_name):
+        stack = self._find_stack(stack_name_or_id)
+        change_set = self.change_sets.get((stack.stack_id, change_set_name)) if stack else None
+        if not change_set:
+            raise ClientError({"Error": {"Code": "ChangeSetNotFound",
+                                         "Message": "ChangeSet [{}] does not exist".format(change_set_name)}},
+                              "DescribeChangeSet")
+        return stack, change_set
+
+    def describe_change_set(self, StackName, ChangeSetName, NextToken=None):
+        self._call()
+        with self.lock:
+            _, change_set = self._change_set(StackName, ChangeSetName)
+            ready = time.monotonic() >= change_set["ReadyAt"]
+            if change_set["Executed"]:
+                execution_status = "EXECUTE_COMPLETE"
+            else:
+                execution_status = "AVAILABLE" if ready else "UNAVAILABLE"
+            return {
+                "ChangeSetName": ChangeSetName,
+                "Status": "CREATE_COMPLETE" if ready else "CREATE_PENDING",
+                "ExecutionStatus": execution_status,
+                "Changes": [{"ResourceChange": {"Action": "Add",
+                                                "ResourceType": "AWS::SNS::Topic",
+                                                "LogicalResourceId": "Topic"}}]
+            }
+
+    def execute_change_set(self, StackName, ChangeSetName):
+        self._call()
+        with self.lock:
+            stack, change_set = self._change_set(StackName, ChangeSetName)
+            change_set["Executed"] = True
+            self._start_operation(stack, change_set["Type"])
+
+    def delete_change_set(self, StackName, ChangeSetName):
+        self._call()
+        with self.lock:
+            stack, _ = self._change_set(StackName, ChangeSetName)
+            del self.change_sets[(stack.stack_id, ChangeSetName)]
+
+    def delete_stack(self, StackName, **kwargs):
+        self._call()
+        with self.lock:
+            stack = self._find_stack(StackName)
+            if stack:
+                self._start_operation(stack, "DELETE")
+
+    def validate_template(self, TemplateBody):
+        self._call()
+        return {"Parameters": []}
@@ -0,0 +1,80 @@
+import time
+import threading
+import boto3
+import botocore
+import botocore.config
+from stacklift.aws_executor import DEFAULT_MAX_WORKERS
+from stacklift.rate_governor import THROTTLING_ERROR_CODES
+from stacklift.metrics import get_metrics
+
+
+class ClientCallObserver:
+    """Reports every attempt of a client's calls to the metrics.
+
+    Used for clients whose calls bypass RateGovernor, which observes the others.
+    Hooked on botocore events, it also sees the calls that s3transfer makes and
+    the retries of botocore.
+    """
+
+    def __init__(self, client):
+        self.service_name = client.meta.service_model.service_name
+        self.region_name = client.meta.region_name
+        # the attempts of a call are made one after another on the calling thread
+        self.local = threading.local()
+        client.meta.events.register("before-send", self.before_send)
+        # first and per service like the retry handler of botocore, which raises the error of the last attempt
+        client.meta.events.register_first("needs-retry.{}".format(client.meta.service_model.service_id.hyphenize()),
+                                          self.needs_retry)
+
+    def before_send(self, **kwargs):
+        self.local.started = time.monotonic()
+
+    def needs_retry(self, response=None, operation=None, attempts=1, **kwargs):
+        started = getattr(self.local, "started", None)
+        if started is None:
+            return
+        self.local.started = None
+        throttled = response is not None and response[1].get("Error", {}).get("Code") in THROTTLING_ERROR_CODES
+        get_metrics().observe_api_call(self.service_name, botocore.xform_name(operation.name), self.region_name,
+                                       time.monotonic() - started, throttled, attempts > 1)
+
+
+class AwsClients:
+    """Clients shared by every stack in a run, keyed by (service, region).
+
+    Each client is created once from a single botocore session, and its
+    connection pool is sized so that every executor thread can hold a connection.
+    Clients of GOVERNED_SERVICES make a single attempt per call, as their calls
+    go through RateGovernor, which paces and counts every retry. Other clients,
+    such as those of S3 transfers, keep the retries of botocore and are
+    observed by ClientCallObserver.
+    """
+
+    GOVERNED_SERVICES = {"cloudformation"}
+
+    def __init__(self, max_pool_connections=DEFAULT_MAX_WORKERS):
+        self.config = botocore.config.Config(max_pool_connections=max_pool_connections)
+        self.governed_config = self.config.merge(botocore.config.Config(retries={"total_max_attempts": 1}))
+        self.lock = threading.Lock()
+        self.session = None
+        self.clients = {}
+
+    def get_client(self, service_name, region_name=None):
+        key = (service_name, region_name)
+        with self.lock:
+            client = self.clients.get(key)
+            if client is None:
+                if self.session is None:
+                    self.session = boto3.session.Session()
+                config = self.governed_config if service_name in self.GOVERNED_SERVICES else self.config
+                client = self.session.client(service_name, region_name=region_name, config=config)
+                if service_name not in self.GOVERNED_SERVICES:
+                    ClientCallObserver(client)
+                self.clients[key] = client
+        return client
+
+    def cloudformation(self, region_name):
+        return self.get_client('cloudformation', region_name=region_name)
+
+    def s3(self):
+        return self.get_client('s3')
@@ -0,0 +1,30 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+# boto3 calls block on network I/O, so they run on a thread pool to let
+# every stack in a group poll and wait concurrently.
+DEFAULT_MAX_WORKERS = 32
+
+_executor = None
+_max_workers = DEFAULT_MAX_WORKERS
+
+
+def set_max_workers(max_workers):
+    global _executor, _max_workers
+    if _executor is not None:
+        _executor.shutdown(wait=False)
+        _executor = None
+    _max_workers = max_workers
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=_max_workers, thread_name_prefix="stacklift-aws")
+    return _executor
+
+
+async def run_blocking(func, *args, **kwargs):
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(get_executor(), functools.partial(func, *args, **kwargs))
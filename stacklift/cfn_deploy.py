@@ -1,13 +1,18 @@
 #!/usr/bin/env python3
 
-import boto3
 import botocore
 import json
 import datetime
+import time
 import logging
 import asyncio
 from enum import Enum, unique, auto
 from stacklift.templates_config import StackDesiredState
+from stacklift.rate_governor import call_api
+from stacklift.aws_clients import AwsClients
+from stacklift.stack_progress import Backoff, StackProgressTracker
+from stacklift.run_journal import RunPhase
+from stacklift.phase_trace import trace_span
 
 
 # logging.basicConfig(format="[%(levelname)s][%(name)s] %(message)s")
@@ -34,13 +39,35 @@ class DeployStatus(Enum):
     CHANGESET_EXECUTED = auto()
     CHANGESET_COMPLETED = auto()
     DELETED = auto()
+    DELETE_PLANNED = auto()
+
+
+class ChangeSetReference:
+    def __init__(self, region_name, stack_name, stack_id, change_set_name, change_set_type, fingerprint=None):
+        self.region_name = region_name
+        self.stack_name = stack_name
+        self.stack_id = stack_id
+        self.change_set_name = change_set_name
+        self.change_set_type = change_set_type
+        self.fingerprint = fingerprint
+
+    def is_deletion(self):
+        return self.change_set_type == "DELETE"
+
+    def to_dict(self):
+        return dict(vars(self))
+
+    @classmethod
+    def from_dict(cls, value):
+        return cls(**value)
 
 
 class CloudFormationDeployResult:
-    def __init__(self, stack_name, deploy_status, change_list=None):
+    def __init__(self, stack_name, deploy_status, change_list=None, change_set=None):
         self.stack_name = stack_name
         self.deploy_status = deploy_status
         self.change_list = change_list or []
+        self.change_set = change_set
 
     def __str__(self):
         return "## {}: {}\n{}".format(self.stack_name, self.deploy_status.name,
@@ -51,6 +78,13 @@ class CloudFormationDeployResult:
 
 
 class CloudFormationDeployer:
+    CHANGE_SET_POLL_INITIAL_DELAY = 1
+    CHANGE_SET_POLL_MAX_DELAY = 10
+    CHANGE_SET_TIMEOUT = 360
+    STACK_POLL_INITIAL_DELAY = 2
+    STACK_POLL_MAX_DELAY = 30
+    STACK_TIMEOUT = 3600
+
     def __init__(self,
                  region_name,
                  stack_name,
@@ -60,8 +94,16 @@ class CloudFormationDeployer:
                  changeset_desired_state,
                  stack_desired_state,
                  role_arn,
-                 capabilities):
-        self.client = boto3.client('cloudformation', region_name=region_name)
+                 capabilities,
+                 aws_clients,
+                 fingerprint=None,
+                 deploy_state=None,
+                 force=False,
+                 stack_snapshot=None,
+                 journal=None,
+                 trace=None):
+        self.region_name = region_name
+        self.client = aws_clients.cloudformation(region_name)
         self.stack_name = stack_name
         self.change_set_name = "{:}-{:%Y%m%d%H%M%S}".format(stack_name, datetime.datetime.utcnow())
 
@@ -73,49 +115,59 @@ class CloudFormationDeployer:
         self.stack_desired_state = stack_desired_state
         self.role_arn = role_arn
         self.capabilities = capabilities
+        self.fingerprint = fingerprint
+        self.deploy_state = deploy_state
+        self.force = force
+        self.stack_snapshot = stack_snapshot
+        self.journal = journal
+        self.trace = trace
+        self.change_set_type = None
+
+    async def describe_stack_or_none(self, refresh=False):
+        if self.stack_snapshot and not refresh:
+            stack = await self.stack_snapshot.get(self.stack_name)
+            return {"Stacks": [stack]} if stack else None
 
-    def describe_stack_or_none(self):
         try:
-            response = self.client.describe_stacks(StackName=self.stack_name)
+            response = await call_api(self.client, "describe_stacks", StackName=self.stack_name)
         except botocore.exceptions.ClientError as e:
             if "Stack with id {0} does not exist".format(self.stack_name) in str(e):
+                if self.stack_snapshot:
+                    self.stack_snapshot.remove(self.stack_name)
                 return None
             raise
+
+        if self.stack_snapshot:
+            self.stack_snapshot.update(response["Stacks"][0])
         return response
 
-    def check_stack_exists(self):
-        response = self.describe_stack_or_none()
+    def is_stack_created(self, response):
         if not response:
             return False
 
         status = response['Stacks'][0]['StackStatus']
         return status != "REVIEW_IN_PROGRESS"
 
-    async def wait_waiter_once(self, waiter, delay, waiter_kwargs, raise_max_attempts=False):
-        await asyncio.sleep(delay)
-        try:
-            waiter.wait(WaiterConfig={'MaxAttempts': 1}, **waiter_kwargs)
-            return True
-        except botocore.exceptions.WaiterError as ex:
-            if raise_max_attempts:
-                raise
-
-            reason = ex.kwargs["reason"]
-            if reason == "Max attempts exceeded":
-                return False
+    def is_recorded_unchanged(self, response):
+        if self.force or not self.fingerprint or not self.deploy_state or not self.is_stack_created(response):
+            return False
+        return self.deploy_state.is_current(self.region_name, response["Stacks"][0], self.fingerprint)
 
-            raise
+    def record_deploy_state(self, response):
+        if self.fingerprint and self.deploy_state and response:
+            self.deploy_state.record(self.region_name, response["Stacks"][0], self.fingerprint)
 
-    async def wait_waiter(self, waiter, delay, max_attempts, waiter_kwargs):
-        for i in range(max_attempts - 1):
-            if await self.wait_waiter_once(waiter, delay, waiter_kwargs):
-                return
+    def span(self, phase):
+        return trace_span(self.trace, self.logger.name, phase)
 
-        await self.wait_waiter_once(waiter, delay, waiter_kwargs, raise_max_attempts=True)
+    def record_phase(self, phase, **fields):
+        if self.journal:
+            self.journal.record(phase, fingerprint=self.fingerprint, **fields)
 
     async def create_change_set(self,
                                 is_update):
         create_or_update = "UPDATE" if is_update else "CREATE"
+        self.change_set_type = create_or_update
 
         with open(self.template_file) as fp:
             template_body = fp.read()
@@ -135,64 +187,82 @@ class CloudFormationDeployer:
         if self.capabilities:
             args['Capabilities'] = [self.capabilities]
 
-        result = self.client.create_change_set(**args)
+        result = await call_api(self.client, "create_change_set", **args)
         stack_id = result["StackId"]
 
-        waiter = self.client.get_waiter("change_set_create_complete")
-        try:
-            await self.wait_waiter(waiter, 3, 120, {
-                "StackName": stack_id,
-                "ChangeSetName": self.change_set_name
-            })
-        except botocore.exceptions.WaiterError as ex:
-            res = ex.last_response
+        backoff = Backoff(self.CHANGE_SET_POLL_INITIAL_DELAY, self.CHANGE_SET_POLL_MAX_DELAY)
+        deadline = time.monotonic() + self.CHANGE_SET_TIMEOUT
+        while True:
+            await backoff.sleep()
+            res = await call_api(self.client, "describe_change_set",
+                                 StackName=stack_id, ChangeSetName=self.change_set_name)
             status = res.get("Status")
-            reason = res.get("StatusReason")
-            if status == "FAILED" and reason and (
-                "The submitted information didn't contain changes." in reason or
-                "No updates are to be performed" in reason):
-                return None
-            else:
-                raise RuntimeError("Failed to create a changeset: {0}: {1}".format(status, reason))
-        return stack_id
-
-    def get_change_list(self):
-        response = self.client.describe_change_set(StackName=self.stack_name, ChangeSetName=self.change_set_name)
-        return [
-            ChangeSetResourceChange(action=x["ResourceChange"]["Action"],
-                                    resource_type=x["ResourceChange"]["ResourceType"],
-                                    logical_resource_id=x["ResourceChange"]["LogicalResourceId"])
-            for x in response["Changes"]
-        ]
-
-    def execute_changeset(self):
-        self.client.execute_change_set(StackName=self.stack_name, ChangeSetName=self.change_set_name)
-
-    def try_describe_stack_events(self, stack_name_or_id, next_token=None):
+            if status == "CREATE_COMPLETE":
+                return stack_id
+            if status not in ("CREATE_PENDING", "CREATE_IN_PROGRESS") or time.monotonic() >= deadline:
+                break
+
+        reason = res.get("StatusReason")
+        if status == "FAILED" and reason and (
+            "The submitted information didn't contain changes." in reason or
+            "No updates are to be performed" in reason):
+            return None
+        else:
+            raise RuntimeError("Failed to create a changeset: {0}: {1}".format(status, reason))
+
+    async def get_change_list(self):
+        change_list = []
+        args = {"StackName": self.stack_name, "ChangeSetName": self.change_set_name}
+        while True:
+            response = await call_api(self.client, "describe_change_set", **args)
+            change_list.extend([
+                ChangeSetResourceChange(action=x["ResourceChange"]["Action"],
+                                        resource_type=x["ResourceChange"]["ResourceType"],
+                                        logical_resource_id=x["ResourceChange"]["LogicalResourceId"])
+                for x in response["Changes"]
+            ])
+
+            if not response.get("NextToken"):
+                return change_list
+            args["NextToken"] = response["NextToken"]
+
+    async def delete_changeset(self):
+        if self.change_set_type == "CREATE":
+            # the stack was only created to hold the change set
+            await call_api(self.client, "delete_stack", StackName=self.stack_name)
+        else:
+            await call_api(self.client, "delete_change_set",
+                           StackName=self.stack_name, ChangeSetName=self.change_set_name)
+
+    async def execute_changeset(self):
+        await call_api(self.client, "execute_change_set",
+                       StackName=self.stack_name, ChangeSetName=self.change_set_name)
+
+    async def try_describe_stack_events(self, stack_name_or_id, next_token=None):
         stack_events_args = {"StackName": stack_name_or_id}
         if next_token:
             stack_events_args["NextToken"] = next_token
 
         try:
-            response = self.client.describe_stack_events(**stack_events_args)
+            response = await call_api(self.client, "describe_stack_events", **stack_events_args)
             return response["StackEvents"], response.get("NextToken")
         except botocore.exceptions.ClientError as ex:
             if "does not exist" in ex.response["Error"]["Message"]:
                 return [], None
             raise
 
-    def get_unrelated_stack_event_id(self):
-        events, _ = self.try_describe_stack_events(self.stack_name)
+    async def get_unrelated_stack_event_id(self):
+        events, _ = await self.try_describe_stack_events(self.stack_name)
         if events:
             return events[0]["EventId"]
         else:
             return None
 
-    def get_stack_events_until(self, stack_name_or_id, boundary_event_id):
+    async def get_stack_events_until(self, stack_name_or_id, boundary_event_id):
         result_events = []
         next_token = None
         while True:
-            events, next_token = self.try_describe_stack_events(stack_name_or_id, next_token)
+            events, next_token = await self.try_describe_stack_events(stack_name_or_id, next_token)
 
             for event in events:
                 if boundary_event_id == event["EventId"]:
@@ -217,28 +287,10 @@ class CloudFormationDeployer:
                 event.get("ResourceStatusReason") or "")
             self.logger.info(line)
 
-    def get_finish_waiter(self, is_update):
-        if is_update:
-            return self.client.get_waiter("stack_update_complete")
-        else:
-            return self.client.get_waiter("stack_create_complete")
-
-    async def wait_waiter_with_events(self, waiter, stack_id, unrelated_stack_event_id):
-        last_event_id = unrelated_stack_event_id
-        for i in range(720):
-            try:
-                if await self.wait_waiter_once(waiter, 5, {"StackName": stack_id}):
-                    return
-            except botocore.exceptions.WaiterError as ex:
-                res = ex.last_response
-                stack = res["Stacks"][0]
-                status = stack["StackStatus"]
-                raise RuntimeError("Waiter detected a failure: {0}".format(status))
-            finally:
-                events = self.get_stack_events_until(stack_id, last_event_id)
-                if events:
-                    last_event_id = events[0]["EventId"]
-                    self.print_stack_events(events)
+    async def wait_stack_operation(self, operation, stack_id, unrelated_stack_event_id):
+        backoff = Backoff(self.STACK_POLL_INITIAL_DELAY, self.STACK_POLL_MAX_DELAY)
+        tracker = StackProgressTracker(self, stack_id, unrelated_stack_event_id, backoff, self.STACK_TIMEOUT)
+        await tracker.wait(operation)
 
     async def deploy(self):
         if self.stack_desired_state == StackDesiredState.DELETED:
@@ -246,59 +298,215 @@ class CloudFormationDeployer:
         else:
             return await self.change_stack()
 
+    async def plan(self, delete_change_set=False):
+        if self.stack_desired_state == StackDesiredState.DELETED:
+            response = await self.describe_stack_or_none()
+            if not response:
+                return CloudFormationDeployResult(stack_name=self.stack_name,
+                                                  deploy_status=DeployStatus.UNCHANGED)
+
+            # a deletion has no change set; the reference pins the stack that was planned to go
+            deletion = ChangeSetReference(region_name=self.region_name,
+                                          stack_name=self.stack_name,
+                                          stack_id=response["Stacks"][0]["StackId"],
+                                          change_set_name=None,
+                                          change_set_type="DELETE")
+            return CloudFormationDeployResult(stack_name=self.stack_name,
+                                              deploy_status=DeployStatus.DELETE_PLANNED,
+                                              change_set=deletion)
+
+        result = await self.change_stack()
+        if delete_change_set and result.deploy_status == DeployStatus.CHANGESET_CREATED:
+            self.logger.info("Deleting the change set...")
+            await self.delete_changeset()
+        return result
+
     async def change_stack(self):
-        is_update = self.check_stack_exists()
+        response = await self.describe_stack_or_none()
+        if self.is_recorded_unchanged(response):
+            self.logger.info("The stack has not changed since the last deploy.")
+            self.record_phase(RunPhase.COMPLETED)
+            return CloudFormationDeployResult(stack_name=self.stack_name,
+                                              deploy_status=DeployStatus.UNCHANGED)
+
+        resumed = await self.resume(response)
+        if resumed:
+            return resumed
+
+        is_update = self.is_stack_created(response)
         self.logger.info("Creating a change set {} ...".format(self.change_set_name))
 
-        unrelated_stack_event_id = self.get_unrelated_stack_event_id()
-        stack_id = await self.create_change_set(is_update=is_update)
+        with self.span("create_change_set"):
+            stack_id = await self.create_change_set(is_update=is_update)
         if not stack_id:
             self.logger.info("The changeset does not contain changes.")
+            self.record_deploy_state(response)
+            self.record_phase(RunPhase.COMPLETED)
             return CloudFormationDeployResult(stack_name=self.stack_name,
                                               deploy_status=DeployStatus.UNCHANGED)
 
-        change_list = self.get_change_list()
+        self.record_phase(RunPhase.CHANGESET_CREATED, stack_id=stack_id,
+                          change_set_name=self.change_set_name, change_set_type=self.change_set_type)
+        return await self.finish_change_set(stack_id)
+
+    async def finish_change_set(self, stack_id):
+        with self.span("describe_change_set"):
+            change_list = await self.get_change_list()
         for c in change_list:
             self.logger.info("> " + str(c))
 
         if self.changeset_desired_state == "created":
+            change_set = ChangeSetReference(region_name=self.region_name,
+                                            stack_name=self.stack_name,
+                                            stack_id=stack_id,
+                                            change_set_name=self.change_set_name,
+                                            change_set_type=self.change_set_type,
+                                            fingerprint=self.fingerprint)
             return CloudFormationDeployResult(stack_name=self.stack_name,
                                               deploy_status=DeployStatus.CHANGESET_CREATED,
-                                              change_list=change_list)
+                                              change_list=change_list,
+                                              change_set=change_set)
 
+        # creating a change set adds no events to an existing stack, so the boundary is taken
+        # only for stacks that are actually going to change
+        unrelated_stack_event_id = await self.get_unrelated_stack_event_id()
         self.logger.info("Executing the change set...")
-        self.execute_changeset()
+        with self.span("execute"):
+            await self.execute_changeset()
+        self.record_phase(RunPhase.EXECUTING, stack_id=stack_id, change_set_name=self.change_set_name,
+                          change_set_type=self.change_set_type, boundary_event_id=unrelated_stack_event_id)
 
         if self.changeset_desired_state == "executed":
             return CloudFormationDeployResult(stack_name=self.stack_name,
                                               deploy_status=DeployStatus.CHANGESET_EXECUTED,
                                               change_list=change_list)
 
-        waiter = self.get_finish_waiter(is_update)
-        await self.wait_waiter_with_events(waiter, stack_id, unrelated_stack_event_id)
+        return await self.wait_change_set(stack_id, unrelated_stack_event_id, change_list)
+
+    async def wait_change_set(self, stack_id, unrelated_stack_event_id, change_list):
+        with self.span("wait"):
+            await self.wait_stack_operation(self.change_set_type, stack_id, unrelated_stack_event_id)
         self.logger.info("Finished.")
+        self.record_deploy_state(await self.describe_stack_or_none(refresh=True))
+        self.record_phase(RunPhase.COMPLETED)
 
         return CloudFormationDeployResult(stack_name=self.stack_name,
                                           deploy_status=DeployStatus.CHANGESET_COMPLETED,
                                           change_list=change_list)
 
+    async def resume(self, response):
+        """Pick up where a previous run of the same inputs left this stack, if it can be."""
+        phase = self.journal.get_previous_phase() if self.journal else None
+        if not phase or self.force or self.journal.previous.get("fingerprint") != self.fingerprint:
+            return None
+
+        previous = self.journal.previous
+        if phase is RunPhase.COMPLETED:
+            self.logger.info("The stack was completed by the previous run.")
+            return CloudFormationDeployResult(stack_name=self.stack_name,
+                                              deploy_status=DeployStatus.UNCHANGED)
+
+        stack = response["Stacks"][0] if response else None
+        if not stack or stack["StackId"] != previous.get("stack_id") or "ROLLBACK" in stack["StackStatus"]:
+            return None
+
+        if phase not in (RunPhase.CHANGESET_CREATED, RunPhase.EXECUTING):
+            return None
+
+        new_change_set_name = self.change_set_name
+        self.change_set_name = previous["change_set_name"]
+        self.change_set_type = previous["change_set_type"]
+        execution_status = await self.get_change_set_execution_status(stack["StackId"])
+
+        # the journal only says the execute call returned; the change set tells whether it really ran
+        if phase is RunPhase.EXECUTING and (execution_status in ("EXECUTE_IN_PROGRESS", "EXECUTE_COMPLETE") or
+                                            stack["StackStatus"].endswith("_IN_PROGRESS")):
+            self.logger.info("Re-attaching to the change set {} executed by the previous run ...".format(
+                self.change_set_name))
+            return await self.wait_change_set(stack["StackId"], previous["boundary_event_id"], [])
+
+        if execution_status == "AVAILABLE":
+            self.logger.info("Reusing the change set {} created by the previous run.".format(self.change_set_name))
+            return await self.finish_change_set(stack["StackId"])
+
+        self.change_set_name = new_change_set_name
+        return None
+
+    async def get_change_set_execution_status(self, stack_id):
+        try:
+            response = await call_api(self.client, "describe_change_set",
+                                      StackName=stack_id, ChangeSetName=self.change_set_name)
+        except botocore.exceptions.ClientError as ex:
+            if ex.response["Error"]["Code"] == "ChangeSetNotFound":
+                return None
+            raise
+        if response["Status"] != "CREATE_COMPLETE":
+            return None
+        return response.get("ExecutionStatus")
+
+    async def check_change_set_available(self, change_set):
+        if change_set.is_deletion():
+            response = await self.describe_stack_or_none(refresh=True)
+            if response and response["Stacks"][0]["StackId"] != change_set.stack_id:
+                raise RuntimeError("Stack {} was replaced since the plan".format(self.stack_name))
+            return
+
+        try:
+            response = await call_api(self.client, "describe_change_set",
+                                      StackName=change_set.stack_id, ChangeSetName=change_set.change_set_name)
+        except botocore.exceptions.ClientError as ex:
+            if ex.response["Error"]["Code"] == "ChangeSetNotFound":
+                raise RuntimeError("Change set {} no longer exists".format(change_set.change_set_name))
+            raise
+
+        if response["Status"] != "CREATE_COMPLETE" or response.get("ExecutionStatus") != "AVAILABLE":
+            raise RuntimeError("Change set {} is no longer available: {} {}".format(
+                change_set.change_set_name, response["Status"], response.get("ExecutionStatus")))
+
+    async def apply_change_set(self, change_set):
+        """Execute a change set created by an earlier plan."""
+        self.change_set_name = change_set.change_set_name
+        self.change_set_type = change_set.change_set_type
+        self.fingerprint = change_set.fingerprint
+
+        change_list = await self.get_change_list()
+        for c in change_list:
+            self.logger.info("> " + str(c))
+
+        unrelated_stack_event_id = await self.get_unrelated_stack_event_id()
+        self.logger.info("Executing the change set {} ...".format(self.change_set_name))
+        await self.execute_changeset()
+
+        result = await self.wait_change_set(change_set.stack_id, unrelated_stack_event_id, change_list)
+        result.change_set = change_set
+        return result
+
     async def delete_stack(self):
-        response = self.describe_stack_or_none()
+        response = await self.describe_stack_or_none()
         if not response:
+            self.record_phase(RunPhase.COMPLETED)
             return CloudFormationDeployResult(stack_name=self.stack_name,
                                               deploy_status=DeployStatus.UNCHANGED)
 
         stack_id = response["Stacks"][0]["StackId"]
 
         # TODO: handle imported stacks
-        unrelated_stack_event_id = self.get_unrelated_stack_event_id()
+        unrelated_stack_event_id = await self.get_unrelated_stack_event_id()
 
         self.logger.info("Deleting a stack {} ...".format(self.stack_name))
-        self.client.delete_stack(StackName=self.stack_name)
+        self.record_phase(RunPhase.EXECUTING, stack_id=stack_id, change_set_type="DELETE",
+                          boundary_event_id=unrelated_stack_event_id)
+        with self.span("delete"):
+            await call_api(self.client, "delete_stack", StackName=self.stack_name)
 
-        waiter = self.client.get_waiter("stack_delete_complete")
-        await self.wait_waiter_with_events(waiter, stack_id, unrelated_stack_event_id)
+        with self.span("wait"):
+            await self.wait_stack_operation("DELETE", stack_id, unrelated_stack_event_id)
         self.logger.info("Deleted.")
+        self.record_phase(RunPhase.COMPLETED)
+        if self.deploy_state:
+            self.deploy_state.forget(self.region_name, self.stack_name)
+        if self.stack_snapshot:
+            self.stack_snapshot.remove(self.stack_name)
 
         return CloudFormationDeployResult(stack_name=self.stack_name,
                                           deploy_status=DeployStatus.DELETED)
@@ -330,6 +538,7 @@ def deploy(opts: CloudFormationDeployerOptions):
         stack_desired_state=opts.stack_desired_state,
         changeset_desired_state=opts.changeset_desired_state,
         role_arn=opts.role_arn,
-        capabilities=opts.capabilities)
+        capabilities=opts.capabilities,
+        aws_clients=AwsClients())
     loop = asyncio.get_event_loop()
     loop.run_until_complete(deployer.deploy())
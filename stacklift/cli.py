@@ -4,9 +4,10 @@ import click
 from stacklift.read_config import ReadConfigOptions, read_config
 from stacklift.global_config import GlobalConfig
 from stacklift.validate_configs import validate_configs
-from stacklift.deploy_group import deploy_group
+from stacklift.deploy_group import deploy_group, destroy_group, plan_group, apply_group
 from stacklift.upload_archive import upload_archive
 from stacklift.extract_archive import extract_archive
+from stacklift.stack_status import stack_status
 
 
 @click.group()
@@ -31,21 +32,79 @@ def read_config_cli(file, section, default, parameter, key):
 
 @cli.command(name="validate-configs")
 @click.option("--override-module-dir", "-m")
+@click.option("--max-workers", type=click.IntRange(min=1))
+@click.option("--watch", is_flag=True, default=False)
 @click.argument("config-files", nargs=-1)
-def validate_config_cli(override_module_dir, config_files):
-    validate_configs(override_module_dir=override_module_dir, config_files=config_files)
+def validate_config_cli(override_module_dir, max_workers, watch, config_files):
+    validate_configs(override_module_dir=override_module_dir, config_files=config_files, max_workers=max_workers,
+                     watch=watch)
 
 @cli.command(name="deploy-group")
 @click.option("--config-file", "-f", required=True)
 @click.option("--group-name", "-g", required=True)
-def deploy_group_cli(config_file, group_name):
-    deploy_group(config_file=config_file, group_name=group_name)
+@click.option("--remote-validation", is_flag=True, default=False)
+@click.option("--max-parallel", type=click.IntRange(min=1))
+@click.option("--force", is_flag=True, default=False)
+@click.option("--resume", is_flag=True, default=False)
+@click.option("--only", "targets", multiple=True)
+@click.option("--with-deps", is_flag=True, default=False)
+@click.option("--with-dependents", is_flag=True, default=False)
+@click.option("--trace", "trace_file")
+@click.option("--metrics-file")
+@click.option("--metrics-port", type=int)
+def deploy_group_cli(config_file, group_name, remote_validation, max_parallel, force, resume, targets, with_deps,
+                     with_dependents, trace_file, metrics_file, metrics_port):
+    if (with_deps or with_dependents) and not targets:
+        raise click.UsageError("--with-deps and --with-dependents require --only")
+    deploy_group(config_file=config_file, group_name=group_name, remote_validation=remote_validation,
+                 max_parallel=max_parallel, force=force, resume=resume,
+                 targets=list(targets), with_deps=with_deps, with_dependents=with_dependents,
+                 trace_file=trace_file, metrics_file=metrics_file, metrics_port=metrics_port)
+
+@cli.command(name="destroy-group")
+@click.option("--config-file", "-f", required=True)
+@click.option("--group-name", "-g", required=True)
+@click.option("--max-parallel", type=click.IntRange(min=1))
+@click.confirmation_option(prompt="Delete every stack of the group?")
+def destroy_group_cli(config_file, group_name, max_parallel):
+    destroy_group(config_file=config_file, group_name=group_name, max_parallel=max_parallel)
+
+@cli.command(name="plan")
+@click.option("--config-file", "-f", required=True)
+@click.option("--group-name", "-g", required=True)
+@click.option("--remote-validation", is_flag=True, default=False)
+@click.option("--max-parallel", type=click.IntRange(min=1))
+@click.option("--force", is_flag=True, default=False)
+@click.option("--delete-change-sets", is_flag=True, default=False)
+@click.option("--manifest", "manifest_file")
+def plan_cli(config_file, group_name, remote_validation, max_parallel, force, delete_change_sets, manifest_file):
+    if delete_change_sets and manifest_file:
+        raise click.UsageError("--manifest cannot be used with --delete-change-sets")
+    plan_group(config_file=config_file, group_name=group_name, remote_validation=remote_validation,
+               max_parallel=max_parallel, force=force, delete_change_sets=delete_change_sets,
+               manifest_file=manifest_file)
+
+@cli.command(name="apply")
+@click.option("--config-file", "-f", required=True)
+@click.option("--group-name", "-g", required=True)
+@click.option("--manifest", "manifest_file", required=True)
+@click.option("--max-parallel", type=click.IntRange(min=1))
+def apply_cli(config_file, group_name, manifest_file, max_parallel):
+    apply_group(config_file=config_file, group_name=group_name, manifest_file=manifest_file,
+                max_parallel=max_parallel)
+
+@cli.command(name="status")
+@click.option("--config-file", "-f", required=True)
+@click.option("--group-name", "-g", required=True)
+def status_cli(config_file, group_name):
+    stack_status(config_file=config_file, group_name=group_name)
 
 @cli.command(name="upload-archive")
 @click.option("--archive-url", required=True)
+@click.option("--part-size-mb", type=int, default=8)
 @click.argument("archive-path", nargs=1)
-def upload_archive_cli(archive_url, archive_path):
-    upload_archive(archive_url=archive_url, archive_path=archive_path)
+def upload_archive_cli(archive_url, part_size_mb, archive_path):
+    upload_archive(archive_url=archive_url, archive_path=archive_path, part_size=part_size_mb * 1024 * 1024)
 
 @cli.command(name="extract-archive")
 @click.option("--config-file", "-f", required=True)
@@ -0,0 +1,141 @@
+from collections import OrderedDict, deque
+
+
+class DependencyGraph:
+    """Validated `Depends` graph of a template group.
+
+    Raises RuntimeError when a template depends on an undefined template or when
+    the dependencies form a cycle.
+    """
+
+    def __init__(self, depends):
+        self.depends = OrderedDict((name, list(targets)) for name, targets in depends.items())
+        self.dependents = OrderedDict((name, []) for name in self.depends)
+
+        for name, targets in self.depends.items():
+            for target in targets:
+                if target not in self.depends:
+                    raise RuntimeError("Template {} depends on undefined template {}".format(name, target))
+                self.dependents[target].append(name)
+
+        self.order = self.topological_order()
+
+    def get_names(self):
+        return list(self.depends.keys())
+
+    def topological_order(self):
+        remaining = {name: len(targets) for name, targets in self.depends.items()}
+        ready = deque(name for name, count in remaining.items() if count == 0)
+        order = []
+        while ready:
+            name = ready.popleft()
+            order.append(name)
+            for dependent in self.dependents[name]:
+                remaining[dependent] -= 1
+                if remaining[dependent] == 0:
+                    ready.append(dependent)
+
+        if len(order) != len(self.depends):
+            raise RuntimeError("Dependency cycle detected: {}".format(" -> ".join(self.find_cycle())))
+        return order
+
+    def find_cycle(self):
+        visiting = []
+        visited = set()
+
+        def visit(name):
+            if name in visiting:
+                return visiting[visiting.index(name):] + [name]
+            if name in visited:
+                return None
+            visiting.append(name)
+            for target in self.depends[name]:
+                cycle = visit(target)
+                if cycle:
+                    return cycle
+            visiting.pop()
+            visited.add(name)
+            return None
+
+        for name in self.depends:
+            cycle = visit(name)
+            if cycle:
+                return cycle
+        return []
+
+    def level_sets(self):
+        """Templates grouped by the length of their longest chain of dependencies."""
+        level_of = {}
+        for name in self.order:
+            level_of[name] = max([level_of[x] + 1 for x in self.depends[name]] or [0])
+
+        levels = [[] for _ in range(max(level_of.values()) + 1)] if level_of else []
+        for name in self.order:
+            levels[level_of[name]].append(name)
+        return levels
+
+    def downstream_lengths(self, weights=None):
+        """Longest weighted path from each template through its dependents, itself included."""
+        lengths = {}
+        for name in reversed(self.order):
+            weight = weights.get(name, 1) if weights else 1
+            lengths[name] = weight + max([lengths[x] for x in self.dependents[name]] or [0])
+        return lengths
+
+    def critical_path(self, weights=None):
+        lengths = self.downstream_lengths(weights)
+        if not lengths:
+            return []
+
+        roots = [name for name in self.order if not self.depends[name]]
+        path = [max(roots, key=lambda x: lengths[x])]
+        while self.dependents[path[-1]]:
+            path.append(max(self.dependents[path[-1]], key=lambda x: lengths[x]))
+        return path
+
+    def critical_path_length(self, weights=None):
+        return max(list(self.downstream_lengths(weights).values()) or [0])
+
+    def subgraph(self, names):
+        """Graph of only `names`, keeping dependencies that pass through templates left out."""
+        names = set(names)
+        nearest = {}
+        for name in self.order:
+            found = []
+            for target in self.depends[name]:
+                for x in ([target] if target in names else nearest[target]):
+                    if x not in found:
+                        found.append(x)
+            nearest[name] = found
+        return DependencyGraph(OrderedDict((name, nearest[name]) for name in self.order if name in names))
+
+    def teardown_graph(self, deleted):
+        """Graph in which the templates in `deleted` wait for their dependents instead of their dependencies.
+
+        The remaining templates stop waiting for deleted ones, so a deletion only
+        starts once nothing left in the group can still import from it.
+        """
+        deleted = set(deleted)
+        depends = OrderedDict()
+        for name, targets in self.depends.items():
+            if name in deleted:
+                depends[name] = list(self.dependents[name])
+            else:
+                depends[name] = [x for x in targets if x not in deleted]
+        return DependencyGraph(depends)
+
+    def closure(self, names, with_depends=False, with_dependents=False):
+        """`names` plus everything they transitively depend on and/or everything that depends on them."""
+        for name in names:
+            if name not in self.depends:
+                raise RuntimeError("Template {} is not defined".format(name))
+
+        selected = set(names)
+        for edges, enabled in ((self.depends, with_depends), (self.dependents, with_dependents)):
+            pending = list(names) if enabled else []
+            while pending:
+                for target in edges[pending.pop()]:
+                    if target not in selected:
+                        selected.add(target)
+                        pending.append(target)
+        return [name for name in self.order if name in selected]
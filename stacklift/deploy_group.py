@@ -2,9 +2,24 @@
 
 import asyncio
 from stacklift.deploy_template import DeployTemplate
-from stacklift.cfn_deploy import DeployStatus
-from stacklift.templates_config import TemplatesConfig
+from stacklift.cfn_deploy import CloudFormationDeployer, DeployStatus
+from stacklift.templates_config import load_templates_config, StackDesiredState
 from stacklift.global_config import GlobalConfig
+from stacklift.aws_clients import AwsClients
+from stacklift.function_archive import FunctionArchiveCache, FunctionPackager
+from stacklift.export_index import ExportIndexes
+from stacklift.rate_governor import get_governor
+from stacklift.scheduler import DeployScheduler, DurationHistory
+from stacklift.deploy_state import DeployState
+from stacklift.stack_snapshot import StackSnapshots
+from stacklift.dependency_graph import DependencyGraph
+from stacklift.plan_manifest import PlanManifest, load_plan_manifest
+from stacklift.run_journal import RunJournal, RunPhase
+from stacklift.phase_trace import PhaseTrace
+from stacklift.metrics import get_metrics, set_current_stack
+import time
+from collections import OrderedDict
+import os
 import logging
 
 logging.basicConfig(format="[%(name)s] %(message)s", level=logging.INFO)
@@ -12,53 +27,237 @@ logger = logging.getLogger(__name__)
 
 
 class DeployGroup:
-    def __init__(self, config_file, group_name):
+    def __init__(self, config_file, group_name, remote_validation=False, max_parallel=None, force=False,
+                 resume=False, targets=None, with_deps=False, with_dependents=False, trace_file=None,
+                 metrics_file=None, metrics_port=None):
         self.config_file = config_file
-        self.templates_config = TemplatesConfig(GlobalConfig(config_file).get_templates_path())
+        self.templates_config = load_templates_config(GlobalConfig(config_file).get_templates_path())
 
         self.group_name = group_name
-        self.deploy_futures = {}
+        self.remote_validation = remote_validation
+        self.max_parallel = max_parallel
+        self.force = force
+        self.resume = resume
+        self.targets = targets
+        self.with_deps = with_deps
+        self.with_dependents = with_dependents
+        self.selected = None
+        self.scope = "{}:{}".format(os.path.abspath(config_file), group_name)
+        self.journal = None
+        self.trace = None
+        self.trace_file = trace_file
+        self.metrics_file = metrics_file
+        self.metrics_port = metrics_port
+        self.dependency_graph = self.templates_config.get_dependency_graph(group_name)
+        self.aws_clients = AwsClients()
+        self.function_packager = FunctionPackager(FunctionArchiveCache())
+        self.export_indexes = ExportIndexes(self.aws_clients)
+        self.deploy_state = DeployState()
+        self.stack_snapshots = StackSnapshots(self.aws_clients)
+        self.duration_history = DurationHistory(self.scope)
 
-    async def deploy(self, name, start_ready_event):
-        await start_ready_event.wait()
+    def create_deploy_template(self, name, template_config, stack_desired_state=None):
+        return DeployTemplate(template_file=template_config.get_template_path(),
+                              config_file=self.config_file,
+                              section_name=name,
+                              stack_desired_state=stack_desired_state or template_config.get_stack_desired_state(),
+                              aws_clients=self.aws_clients,
+                              function_packager=self.function_packager,
+                              export_indexes=self.export_indexes,
+                              deploy_state=self.deploy_state,
+                              stack_snapshots=self.stack_snapshots,
+                              remote_validation=self.remote_validation,
+                              force=self.force,
+                              journal=self.journal.for_stack(name) if self.journal else None,
+                              trace=self.trace)
 
+    async def deploy(self, name, depend_results):
+        metrics = get_metrics()
+        set_current_stack(name)
+        started = time.monotonic()
+        metrics.start_stack()
+        result = None
+        try:
+            result = await self.deploy_stack(name, depend_results)
+            return result
+        finally:
+            if result:
+                status = result.deploy_status.name
+            else:
+                status = "NOT_STARTED" if depend_results and not all(depend_results) else "FAILED"
+            metrics.finish_stack(name, status, time.monotonic() - started)
+
+    async def deploy_stack(self, name, depend_results):
         logger = logging.getLogger(name)
         logger.setLevel(logging.INFO)
 
         template_config = self.templates_config.get_template_config(self.group_name, name)
-        depends = template_config.get_depends()
-        if depends:
-            depend_results = await asyncio.gather(*[self.deploy_futures[x] for x in depends])
+        if depend_results:
             if not all(depend_results):
                 logger.info("Not start")
                 return None
 
             if not all([x.deploy_status in [DeployStatus.UNCHANGED,
-                                            DeployStatus.CHANGESET_COMPLETED] for x in depend_results]):
+                                            DeployStatus.CHANGESET_COMPLETED,
+                                            DeployStatus.DELETED] for x in depend_results]):
                 raise RuntimeError("Dependent stack(s) did not complete changing")
 
         try:
-            template_file = template_config.get_template_path()
-            function_root = template_config.get_function_root()
+            deploy_template = self.create_deploy_template(name, template_config)
+            if self.selected is not None and name not in self.selected:
+                logger.info("Checking (not selected)")
+                return await deploy_template.check_stack()
 
-            deploy_template = DeployTemplate(template_file=template_file,
-                                             config_file=self.config_file,
-                                             section_name=name,
-                                             stack_desired_state=template_config.get_stack_desired_state())
-            deploy_result = await deploy_template.deploy(function_root=function_root)
+            deploy_result = await deploy_template.deploy(function_root=template_config.get_function_root())
 
             return deploy_result
         except:
             logger.exception("Failed to deploy")
+            if self.journal:
+                self.journal.record(name, RunPhase.FAILED)
+            return None
+
+    async def destroy(self, name, depend_results):
+        logger = logging.getLogger(name)
+        logger.setLevel(logging.INFO)
+
+        if depend_results and not all(depend_results):
+            logger.info("Not start")
+            return None
+
+        template_config = self.templates_config.get_template_config(self.group_name, name)
+        try:
+            deploy_template = self.create_deploy_template(name, template_config, StackDesiredState.DELETED)
+            return await deploy_template.deploy(function_root=None)
+        except:
+            logger.exception("Failed to delete")
+            return None
+
+    def get_deleted_names(self):
+        return [name for name, x in self.templates_config.get_group_template_configs(self.group_name).items()
+                if x.get_stack_desired_state() == StackDesiredState.DELETED]
+
+    async def plan(self, name, delete_change_sets):
+        logger = logging.getLogger(name)
+        logger.setLevel(logging.INFO)
+
+        template_config = self.templates_config.get_template_config(self.group_name, name)
+        try:
+            deploy_template = self.create_deploy_template(name, template_config)
+            return await deploy_template.deploy(function_root=template_config.get_function_root(),
+                                                plan=True, delete_change_set=delete_change_sets)
+        except:
+            logger.exception("Failed to plan")
+            return None
+
+    def create_change_set_deployer(self, name, change_set):
+        return CloudFormationDeployer(region_name=change_set.region_name,
+                                      stack_name=change_set.stack_name,
+                                      logger_name=name,
+                                      template_file=None,
+                                      template_parameters=None,
+                                      changeset_desired_state="completed",
+                                      stack_desired_state=StackDesiredState.DELETED if change_set.is_deletion()
+                                      else StackDesiredState.PRESENT,
+                                      role_arn=None,
+                                      capabilities=None,
+                                      aws_clients=self.aws_clients,
+                                      deploy_state=self.deploy_state,
+                                      stack_snapshot=self.stack_snapshots.get(change_set.region_name))
+
+    async def check_change_set(self, name, change_set):
+        try:
+            await self.create_change_set_deployer(name, change_set).check_change_set_available(change_set)
+            return None
+        except Exception as ex:
+            return "{}: {}".format(name, ex)
+
+    async def apply(self, name, depend_results, change_set):
+        logger = logging.getLogger(name)
+        logger.setLevel(logging.INFO)
+
+        if depend_results and not all(depend_results):
+            logger.info("Not start")
             return None
 
+        try:
+            deployer = self.create_change_set_deployer(name, change_set)
+            if change_set.is_deletion():
+                return await deployer.delete_stack()
+            return await deployer.apply_change_set(change_set)
+        except:
+            logger.exception("Failed to apply")
+            return None
+
+    def select_names(self, graph):
+        """Targets with their closure, plus the stacks they wait on, which are only checked."""
+        if not self.targets:
+            return list(self.templates_config.get_group_template_names(self.group_name))
+
+        self.selected = set(self.dependency_graph.closure(self.targets, with_depends=self.with_deps,
+                                                          with_dependents=self.with_dependents))
+        waited = set(x for name in self.selected for x in graph.depends[name])
+        return [name for name in graph.order if name in self.selected or name in waited]
+
+    def record_blocked_spans(self, scheduler, graph, names):
+        for name in names:
+            if name not in scheduler.start_times:
+                continue
+            if any(x in names for x in graph.depends[name]):
+                self.trace.add(name, "blocked", scheduler.started, scheduler.ready_times[name])
+            if scheduler.start_times[name] > scheduler.ready_times[name]:
+                # waiting for a --max-parallel slot
+                self.trace.add(name, "queued", scheduler.ready_times[name], scheduler.start_times[name])
+
+    def format_critical_path(self, scheduler, graph, names):
+        durations = {name: scheduler.durations.get(name, 0.0) for name in names}
+        subgraph = graph.subgraph(names)
+        path = subgraph.critical_path(durations)
+        lines = ["", "# Critical path ({:.1f}s of {:.1f}s, {} stack(s) in {} level(s))".format(
+            subgraph.critical_path_length(durations), time.monotonic() - scheduler.started,
+            len(names), len(subgraph.level_sets())), ""]
+        for name in path:
+            phases = sorted(self.trace.get_phase_durations(name).items(), key=lambda x: -x[1])
+            lines.append("{:<32} {:>8.1f}s  {}".format(
+                name, durations[name], ", ".join("{} {:.1f}s".format(k, v) for k, v in phases
+                                                 if k != "blocked")))
+        return "\n".join(lines)
+
     async def deploy_all(self):
-        start_ready_event = asyncio.Event()
-        for name in self.templates_config.get_group_template_names(self.group_name):
-            self.deploy_futures[name] = asyncio.ensure_future(self.deploy(name, start_ready_event))
-        start_ready_event.set()
+        if self.metrics_port:
+            get_metrics().serve(self.metrics_port)
+        try:
+            await self.deploy_all_stacks()
+        finally:
+            if self.metrics_file:
+                get_metrics().write_textfile(self.metrics_file)
+
+    async def deploy_all_stacks(self):
+        self.journal = RunJournal(self.scope, resume=self.resume)
+        self.trace = PhaseTrace()
+        graph = self.dependency_graph.teardown_graph(self.get_deleted_names())
+        names = self.select_names(graph)
+        scheduler = DeployScheduler(graph, self.deploy,
+                                    max_parallel=self.max_parallel,
+                                    weights=self.duration_history.get_weights(names))
+        try:
+            results_by_name = await scheduler.run(names)
+        finally:
+            self.function_packager.shutdown()
+
+        # unchanged stacks return at once, so only real deploys tell how long a stack takes
+        for name, result in results_by_name.items():
+            if (result and result.deploy_status in (DeployStatus.CHANGESET_COMPLETED, DeployStatus.DELETED)
+                    and (self.selected is None or name in self.selected)):
+                self.duration_history.record(name, scheduler.durations[name])
+        self.duration_history.save()
+
+        self.record_blocked_spans(scheduler, graph, names)
+        if self.trace_file:
+            self.trace.save(self.trace_file)
+        logger.info(self.format_critical_path(scheduler, graph, names))
 
-        results = await asyncio.gather(*self.deploy_futures.values())
+        results = [results_by_name[name] for name in names]
         if not all(results):
             raise RuntimeError("Deploy failed")
 
@@ -69,9 +268,131 @@ class DeployGroup:
                 lines.append("")
 
         logger.info("\n".join(lines))
+        logger.info("API calls\n{}".format(get_governor().format_stats()))
+
+    async def destroy_all(self):
+        names = list(self.templates_config.get_group_template_names(self.group_name))
+        scheduler = DeployScheduler(self.dependency_graph.teardown_graph(names), self.destroy,
+                                    max_parallel=self.max_parallel)
+        results_by_name = await scheduler.run()
+
+        results = [results_by_name[name] for name in names]
+        deleted = [x.stack_name for x in results if x and x.deploy_status is DeployStatus.DELETED]
+        logger.info("\n".join(["", "# Deleted", ""] + ["* {}".format(x) for x in deleted]))
+        logger.info("API calls\n{}".format(get_governor().format_stats()))
+
+        if not all(results):
+            raise RuntimeError("Destroy failed")
+
+    async def plan_all(self, delete_change_sets=False, manifest_file=None):
+        names = list(self.templates_config.get_group_template_names(self.group_name))
+
+        # change sets do not wait for upstream stacks, so every stack is ready at once
+        independent_graph = DependencyGraph(OrderedDict((name, []) for name in names))
+        scheduler = DeployScheduler(independent_graph,
+                                    lambda name, _: self.plan(name, delete_change_sets),
+                                    max_parallel=self.max_parallel,
+                                    weights=self.duration_history.get_weights(names))
+        try:
+            results_by_name = await scheduler.run()
+        finally:
+            self.function_packager.shutdown()
+
+        counts = {status: 0 for status in DeployStatus}
+        lines = ["", "# Plan", ""]
+        for name in names:
+            result = results_by_name[name]
+            if not result:
+                lines.append("## {}: FAILED".format(name))
+                lines.append("")
+                continue
+
+            counts[result.deploy_status] += 1
+            if result.deploy_status is not DeployStatus.UNCHANGED:
+                lines.append(str(result))
+                lines.append("")
+
+        failed = len([x for x in results_by_name.values() if not x])
+        lines.append("{} to change, {} to delete, {} unchanged, {} failed.".format(
+            counts[DeployStatus.CHANGESET_CREATED], counts[DeployStatus.DELETE_PLANNED],
+            counts[DeployStatus.UNCHANGED], failed))
+        logger.info("\n".join(lines))
+
+        if failed:
+            raise RuntimeError("Plan failed")
+
+        if manifest_file:
+            change_sets = OrderedDict((name, results_by_name[name].change_set) for name in names
+                                      if results_by_name[name].deploy_status in (DeployStatus.CHANGESET_CREATED,
+                                                                                 DeployStatus.DELETE_PLANNED))
+            PlanManifest(self.group_name, change_sets).save(manifest_file)
+            logger.info("Saved {} change set(s) and {} deletion(s) to {}".format(
+                counts[DeployStatus.CHANGESET_CREATED], counts[DeployStatus.DELETE_PLANNED], manifest_file))
+
+    async def apply_all(self, manifest_file):
+        manifest = load_plan_manifest(manifest_file)
+        if manifest.group_name != self.group_name:
+            raise RuntimeError("Manifest {} was planned for group {}".format(manifest_file, manifest.group_name))
+
+        names = list(manifest.change_sets.keys())
+        for name in names:
+            if name not in self.dependency_graph.depends:
+                raise RuntimeError("Template {} in the manifest is not in group {}".format(name, self.group_name))
+
+        # refuse the whole manifest before anything runs if any change set went stale
+        errors = await asyncio.gather(*[self.check_change_set(name, manifest.change_sets[name]) for name in names])
+        errors = [x for x in errors if x]
+        if errors:
+            raise RuntimeError("Change set(s) changed since the plan:\n{}".format("\n".join(errors)))
+
+        # deletions wait for the stacks that depend on them, as in deploy-group
+        deleted = [name for name in names if manifest.change_sets[name].is_deletion()]
+        scheduler = DeployScheduler(self.dependency_graph.teardown_graph(deleted).subgraph(names),
+                                    lambda name, depend_results: self.apply(name, depend_results,
+                                                                            manifest.change_sets[name]),
+                                    max_parallel=self.max_parallel,
+                                    weights=self.duration_history.get_weights(names))
+        results_by_name = await scheduler.run()
+
+        results = [results_by_name[name] for name in names]
+        if not all(results):
+            raise RuntimeError("Apply failed")
+
+        lines = ["", "# Changes", ""]
+        for result in results:
+            lines.append(str(result))
+            lines.append("")
+
+        logger.info("\n".join(lines))
+        logger.info("API calls\n{}".format(get_governor().format_stats()))
 
 
-def deploy_group(config_file, group_name):
-    instance = DeployGroup(config_file=config_file, group_name=group_name)
+def deploy_group(config_file, group_name, remote_validation=False, max_parallel=None, force=False, resume=False,
+                 targets=None, with_deps=False, with_dependents=False, trace_file=None, metrics_file=None,
+                 metrics_port=None):
+    instance = DeployGroup(config_file=config_file, group_name=group_name, remote_validation=remote_validation,
+                           max_parallel=max_parallel, force=force, resume=resume,
+                           targets=targets, with_deps=with_deps, with_dependents=with_dependents,
+                           trace_file=trace_file, metrics_file=metrics_file, metrics_port=metrics_port)
     loop = asyncio.get_event_loop()
     loop.run_until_complete(instance.deploy_all())
+
+
+def destroy_group(config_file, group_name, max_parallel=None):
+    instance = DeployGroup(config_file=config_file, group_name=group_name, max_parallel=max_parallel)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(instance.destroy_all())
+
+
+def plan_group(config_file, group_name, remote_validation=False, max_parallel=None, force=False,
+               delete_change_sets=False, manifest_file=None):
+    instance = DeployGroup(config_file=config_file, group_name=group_name, remote_validation=remote_validation,
+                           max_parallel=max_parallel, force=force)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(instance.plan_all(delete_change_sets=delete_change_sets, manifest_file=manifest_file))
+
+
+def apply_group(config_file, group_name, manifest_file, max_parallel=None):
+    instance = DeployGroup(config_file=config_file, group_name=group_name, max_parallel=max_parallel)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(instance.apply_all(manifest_file))
@@ -0,0 +1,67 @@
+import os
+import json
+import hashlib
+from stacklift.local_state import default_cache_dir, load_json, save_json
+
+STABLE_STATUSES = {"CREATE_COMPLETE", "UPDATE_COMPLETE", "IMPORT_COMPLETE"}
+
+
+def file_digest(path):
+    hasher = hashlib.sha256()
+    with open(path, "rb") as fp:
+        hasher.update(fp.read())
+    return hasher.hexdigest()
+
+
+def make_fingerprint(template_file, parameters, capabilities, role_arn, function_key):
+    """Digest of everything a change set for the stack would be created from."""
+    inputs = {
+        "template": file_digest(template_file),
+        "parameters": parameters,
+        "capabilities": capabilities,
+        "role_arn": role_arn,
+        "function_key": function_key,
+    }
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+
+def get_stack_version(stack):
+    return "{}:{}".format(stack["StackId"], stack.get("LastUpdatedTime") or stack.get("CreationTime"))
+
+
+class DeployState:
+    """Fingerprints of the last completed deploy of each stack.
+
+    A record only counts while the stack is stable and has not been updated
+    since, so deploys made from elsewhere are never mistaken for unchanged.
+    """
+
+    def __init__(self, cache_dir=None):
+        self.path = os.path.join(cache_dir or default_cache_dir(), "deploy-state.json")
+        self.records = load_json(self.path)
+
+    def key(self, region_name, stack_name):
+        return "{}:{}".format(region_name, stack_name)
+
+    def is_current(self, region_name, stack, fingerprint):
+        record = self.records.get(self.key(region_name, stack["StackName"]))
+        return bool(record) and \
+            stack["StackStatus"] in STABLE_STATUSES and \
+            record["fingerprint"] == fingerprint and \
+            record["version"] == get_stack_version(stack)
+
+    def update(self, key, record):
+        # merge with the file so that concurrent runs on other groups are kept
+        self.records = load_json(self.path)
+        if record:
+            self.records[key] = record
+        else:
+            self.records.pop(key, None)
+        save_json(self.path, self.records)
+
+    def record(self, region_name, stack, fingerprint):
+        self.update(self.key(region_name, stack["StackName"]),
+                    {"fingerprint": fingerprint, "version": get_stack_version(stack)})
+
+    def forget(self, region_name, stack_name):
+        self.update(self.key(region_name, stack_name), None)
@@ -1,106 +1,84 @@
 #!/usr/bin/env python3
 
 from stacklift.read_config import ConfigReader
-from stacklift.cfn_deploy import CloudFormationDeployer
+from stacklift.cfn_deploy import CloudFormationDeployer, CloudFormationDeployResult, DeployStatus
 from stacklift.templates_config import StackDesiredState
-import boto3
-import os
-import zipfile
-import contextlib
-import hashlib
-import uuid
-import tempfile
-import botocore
+from stacklift.rate_governor import call_api
+from stacklift.function_archive import FunctionArchiveCache, FunctionPackager
+from stacklift.template_analyzer import analyze_template
+from stacklift.export_index import ExportIndexes
+from stacklift.deploy_state import DeployState, STABLE_STATUSES, make_fingerprint
+from stacklift.stack_snapshot import StackSnapshots
+from stacklift.run_journal import RunPhase
+from stacklift.phase_trace import trace_span
 import re
 
 
-def update_hash(hasher, file_name):
-    block_size = 4096
-    with open(file_name, "rb") as fp:
-        buf = fp.read(block_size)
-        while len(buf) > 0:
-            hasher.update(buf)
-            buf = fp.read(block_size)
-
-
-def zip_dir(temp_archive_path, target_dir):
-    hasher = hashlib.md5()
-
-    target_root = os.path.abspath(target_dir)
-    with open(temp_archive_path, 'wb') as f:
-        zip_file = zipfile.ZipFile(f, 'w', zipfile.ZIP_DEFLATED)
-        with contextlib.closing(zip_file) as z:
-            for root, _, files in os.walk(target_root):
-                for filename in files:
-                    full_path = os.path.join(root, filename)
-                    relative_path = os.path.relpath(full_path, target_root)
-                    z.write(full_path, relative_path)
-
-                    update_hash(hasher, full_path)
-
-    digest = hasher.hexdigest()
-    return "{}.zip".format(digest)
-
-
-@contextlib.contextmanager
-def archive(target_dir):
-    temp_archive_path = os.path.join(tempfile.gettempdir(), "archive-{}.zip".format(uuid.uuid4().hex))
-
-    try:
-        candidate_filename = zip_dir(temp_archive_path, target_dir)
-        yield (temp_archive_path, candidate_filename)
-    finally:
-        if os.path.exists(temp_archive_path):
-            os.remove(temp_archive_path)
-
-
 class DeployTemplate:
-    def __init__(self, template_file, config_file, section_name, stack_desired_state):
+    def __init__(self, template_file, config_file, section_name, stack_desired_state, aws_clients,
+                 function_packager=None, export_indexes=None, deploy_state=None, stack_snapshots=None,
+                 remote_validation=False, force=False, journal=None, trace=None):
         self.template_file = template_file
         self.config_reader = ConfigReader(config_file)
         self.section_name = section_name
         self.stack_desired_state = stack_desired_state
         self.region = self.config_reader.get_value(self.section_name, "Region")
-        self.client = boto3.client('cloudformation', region_name=self.region)
-        self.s3 = boto3.client('s3')
+        self.aws_clients = aws_clients
+        self.client = aws_clients.cloudformation(self.region)
+        self.s3 = aws_clients.s3()
+        self.function_packager = function_packager or FunctionPackager(FunctionArchiveCache())
+        self.export_index = (export_indexes or ExportIndexes(aws_clients)).get(self.region)
+        self.deploy_state = deploy_state or DeployState()
+        self.stack_snapshot = (stack_snapshots or StackSnapshots(aws_clients)).get(self.region)
+        self.remote_validation = remote_validation
+        self.force = force
+        self.journal = journal
+        self.trace = trace
+
+    async def get_export_value(self, export_name):
+        return await self.export_index.get_value(export_name)
+
+    async def get_parameter_names(self, template_file):
+        if not self.remote_validation:
+            return analyze_template(template_file).all
 
-    def get_export_value(self, export_name):
-        paginator = self.client.get_paginator('list_exports')
-        page_iterator = paginator.paginate()
-
-        for page in page_iterator:
-            for export in page["Exports"]:
-                if export["Name"] == export_name:
-                    return export["Value"]
-
-        raise RuntimeError("Failed to get a export value: {}".format(export_name))
-
-    def get_parameter_names(self, template_file):
         with open(template_file) as fp:
-            response = self.client.validate_template(TemplateBody=fp.read())
+            response = await call_api(self.client, "validate_template", TemplateBody=fp.read())
 
         return [parameter["ParameterKey"] for parameter in response["Parameters"]]
 
-    def upload_function(self, deploy_bucket_name, function_root):
-        # TODO: share the same function_root archives
-        with archive(function_root) as (temp_path, candidate_filename):
-            key_name = "function/{}".format(candidate_filename)
-            if not self.check_file_exists(deploy_bucket_name, key_name):
-                self.s3.upload_file(temp_path, deploy_bucket_name, key_name)
+    async def upload_function(self, deploy_bucket_name, function_root):
+        return await self.function_packager.upload(self.s3, deploy_bucket_name, function_root)
 
-            return key_name
+    async def check_stack(self):
+        """Confirm from the stack snapshot that the stack is already in its desired state, without deploying it."""
+        stack_name = self.config_reader.get_value(self.section_name, "StackName")
+        stack = await self.stack_snapshot.get(stack_name)
+        if self.stack_desired_state == StackDesiredState.DELETED:
+            is_desired = stack is None
+        else:
+            is_desired = stack is not None and stack["StackStatus"] in STABLE_STATUSES
+
+        if not is_desired:
+            raise RuntimeError("Stack {} is not {}: {}".format(stack_name, self.stack_desired_state.value,
+                                                               stack["StackStatus"] if stack else "NOT_FOUND"))
+        return CloudFormationDeployResult(stack_name=stack_name, deploy_status=DeployStatus.UNCHANGED)
 
-    async def deploy(self, function_root):
+    async def deploy(self, function_root, plan=False, delete_change_set=False):
         if self.stack_desired_state == StackDesiredState.DELETED:
             params = {}
         else:
-            parameter_names = self.get_parameter_names(self.template_file)
+            with trace_span(self.trace, self.section_name, "validate"):
+                parameter_names = await self.get_parameter_names(self.template_file)
             params = self.config_reader.get_parameters(self.section_name, parameter_names)
 
             if function_root:
                 deploy_bucket_name = self.config_reader.get_value(self.section_name, "DeployBucketName")
-                deploy_code_key = self.upload_function(deploy_bucket_name=deploy_bucket_name,
-                                                       function_root=function_root)
+                with trace_span(self.trace, self.section_name, "package"):
+                    deploy_code_key = await self.upload_function(deploy_bucket_name=deploy_bucket_name,
+                                                                 function_root=function_root)
+                if self.journal:
+                    self.journal.record(RunPhase.PACKAGED, function_key=deploy_code_key)
             else:
                 deploy_bucket_name = ""
                 deploy_code_key = ""
@@ -114,9 +92,21 @@ class DeployTemplate:
         stack_name = self.config_reader.get_value(self.section_name, "StackName")
         changeset_desired_state = self.config_reader.get_value_or_default(self.section_name, "ChangesetDesiredState",
                                                                           "completed")
+        if plan:
+            changeset_desired_state = "created"
         capabilities = self.config_reader.get_value_or_default(self.section_name, "Capabilities", "CAPABILITY_IAM")
-        role_export_name = self.config_reader.get_value_or_default(self.section_name, "CloudFormationRoleExport")
-        role_arn = self.get_export_value(role_export_name) if role_export_name else None
+        role_arn = None
+        fingerprint = None
+        # delete_stack passes no role, and the stack exporting it may already be gone
+        if self.stack_desired_state != StackDesiredState.DELETED:
+            role_export_name = self.config_reader.get_value_or_default(self.section_name, "CloudFormationRoleExport")
+            with trace_span(self.trace, self.section_name, "resolve_exports"):
+                role_arn = await self.get_export_value(role_export_name) if role_export_name else None
+            fingerprint = make_fingerprint(template_file=self.template_file,
+                                           parameters=params,
+                                           capabilities=capabilities,
+                                           role_arn=role_arn,
+                                           function_key=deploy_code_key)
 
         deployer = CloudFormationDeployer(region_name=self.region,
                                           stack_name=stack_name,
@@ -126,13 +116,21 @@ class DeployTemplate:
                                           stack_desired_state=self.stack_desired_state,
                                           capabilities=capabilities,
                                           role_arn=role_arn,
-                                          template_parameters=params)
+                                          template_parameters=params,
+                                          aws_clients=self.aws_clients,
+                                          fingerprint=fingerprint,
+                                          deploy_state=self.deploy_state,
+                                          force=self.force,
+                                          stack_snapshot=self.stack_snapshot,
+                                          journal=self.journal,
+                                          trace=self.trace)
+        if plan:
+            return await deployer.plan(delete_change_set=delete_change_set)
+
         change_list = await deployer.deploy()
+        if change_list.deploy_status in (DeployStatus.CHANGESET_EXECUTED,
+                                         DeployStatus.CHANGESET_COMPLETED,
+                                         DeployStatus.DELETED):
+            # the stack may have added or removed exports other stacks are waiting for
+            self.export_index.invalidate()
         return change_list
-
-    def check_file_exists(self, bucket_name, key_name):
-        try:
-            self.s3.head_object(Bucket=bucket_name, Key=key_name)
-            return True
-        except botocore.exceptions.ClientError:
-            return False
@@ -0,0 +1,66 @@
+import asyncio
+from stacklift.rate_governor import call_api
+
+
+class ExportIndex:
+    """CloudFormation exports of one region, listed lazily and shared by a run.
+
+    Pages of list_exports are fetched only until the requested names are found;
+    later lookups continue from the same cursor. invalidate() drops everything so
+    that exports added by a stack deployed in this run are picked up.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.lock = None
+        self.generation = 0
+        self.invalidate()
+
+    def invalidate(self):
+        self.generation += 1
+        self.exports = {}
+        self.next_token = None
+        self.listed = False
+
+    async def fetch_page(self):
+        generation = self.generation
+        args = {"NextToken": self.next_token} if self.next_token else {}
+        response = await call_api(self.client, "list_exports", **args)
+        if generation != self.generation:
+            return
+
+        for export in response["Exports"]:
+            self.exports[export["Name"]] = export["Value"]
+
+        self.next_token = response.get("NextToken")
+        if not self.next_token:
+            self.listed = True
+
+    async def get_values(self, export_names):
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+
+        async with self.lock:
+            while not self.listed and not all(x in self.exports for x in export_names):
+                await self.fetch_page()
+
+        missing = [x for x in export_names if x not in self.exports]
+        if missing:
+            raise RuntimeError("Failed to get a export value: {}".format(", ".join(missing)))
+        return {x: self.exports[x] for x in export_names}
+
+    async def get_value(self, export_name):
+        return (await self.get_values([export_name]))[export_name]
+
+
+class ExportIndexes:
+    def __init__(self, aws_clients):
+        self.aws_clients = aws_clients
+        self.indexes = {}
+
+    def get(self, region_name):
+        index = self.indexes.get(region_name)
+        if index is None:
+            index = ExportIndex(self.aws_clients.cloudformation(region_name))
+            self.indexes[region_name] = index
+        return index
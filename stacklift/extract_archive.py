@@ -1,25 +1,66 @@
 from stacklift.global_config import GlobalConfig
-import boto3
+from stacklift.aws_clients import AwsClients
+from stacklift.function_archive import file_sha256
+from stacklift.local_state import load_json, save_json
+from stacklift.s3_transfer import RangedObjectReader
 from urllib.parse import urlparse
 import tempfile
+import tarfile
 import shutil
+import io
 import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+MARKER_FILE = ".stacklift-archive.json"
+STREAMABLE_SUFFIXES = (".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz")
+
+
+def extract_with_marker(target_dir, source, extract):
+    """Extract unless the marker shows `source` is already in target_dir.
+
+    The marker is removed first, so an interrupted extraction is never taken as current.
+    """
+    marker_path = os.path.join(target_dir, MARKER_FILE)
+    if load_json(marker_path) == source:
+        logger.info("The archive is already extracted to {}".format(target_dir))
+        return
+
+    if os.path.exists(marker_path):
+        os.remove(marker_path)
+    extract()
+    save_json(marker_path, source)
 
 
 def extract_archive_file(path, target_dir):
-    shutil.unpack_archive(path, target_dir)
+    source = {"location": os.path.abspath(path), "digest": file_sha256(path)}
+    extract_with_marker(target_dir, source, lambda: shutil.unpack_archive(path, target_dir))
+
+
+def extract_archive_s3(bucket, key, target_dir, aws_clients):
+    s3 = aws_clients.s3()
+    head = s3.head_object(Bucket=bucket, Key=key)
+    source = {"location": "s3://{}/{}".format(bucket, key), "etag": head["ETag"]}
 
+    def extract():
+        reader = io.BufferedReader(RangedObjectReader(s3, bucket, key, head["ContentLength"], head["ETag"]))
+        with reader:
+            if key.endswith(STREAMABLE_SUFFIXES):
+                # tar members are written out as they arrive, without the archive ever touching the disk
+                with tarfile.open(fileobj=reader, mode="r|*") as tar:
+                    tar.extractall(target_dir)
+            else:
+                # zip needs random access to its central directory, so it is spooled to a file first
+                with tempfile.NamedTemporaryFile(suffix=os.path.basename(key)) as temp:
+                    shutil.copyfileobj(reader, temp, 1024 * 1024)
+                    temp.flush()
+                    shutil.unpack_archive(temp.name, target_dir)
 
-def extract_archive_s3(bucket, key, target_dir):
-    s3 = boto3.client('s3')
-    response = s3.get_object(Bucket=bucket, Key=key)
-    with tempfile.NamedTemporaryFile(suffix=os.path.basename(key)) as temp:
-        shutil.copyfileobj(response["Body"], temp)
-        temp.flush()
-        shutil.unpack_archive(temp.name, target_dir)
+    extract_with_marker(target_dir, source, extract)
 
 
-def extract_archive(config_file):
+def extract_archive(config_file, aws_clients=None):
     config_dir = os.path.dirname(config_file)
 
     global_config = GlobalConfig(config_file)
@@ -28,6 +69,6 @@ def extract_archive(config_file):
 
     if archive_location.startswith("s3://"):
         url = urlparse(archive_location)
-        extract_archive_s3(url.netloc, url.path.lstrip('/'), module_dir)
+        extract_archive_s3(url.netloc, url.path.lstrip('/'), module_dir, aws_clients or AwsClients())
     else:
         extract_archive_file(os.path.join(config_dir, archive_location), module_dir)
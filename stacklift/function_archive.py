@@ -0,0 +1,267 @@
+import os
+import sys
+import stat
+import shutil
+import time
+import hashlib
+import zipfile
+import asyncio
+import tempfile
+import threading
+import multiprocessing
+import botocore
+from concurrent.futures import ProcessPoolExecutor
+from stacklift.aws_executor import run_blocking
+from stacklift.local_state import default_cache_dir, load_json, save_json
+
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+ARCHIVE_MAX_AGE = 30 * 24 * 60 * 60
+ARCHIVE_MAX_COUNT = 100
+TEMP_ARCHIVE_MAX_AGE = 24 * 60 * 60
+UPLOADED_MAX_AGE = 24 * 60 * 60
+
+
+def file_sha256(path):
+    hasher = hashlib.sha256()
+    with open(path, "rb") as fp:
+        for buf in iter(lambda: fp.read(1024 * 1024), b""):
+            hasher.update(buf)
+    return hasher.hexdigest()
+
+
+def list_tree(root):
+    """Yield (relative_path, full_path) of every file under root in a stable order."""
+    for dir_path, dir_names, file_names in os.walk(root):
+        dir_names.sort()
+        for file_name in sorted(file_names):
+            full_path = os.path.join(dir_path, file_name)
+            yield os.path.relpath(full_path, root).replace(os.sep, "/"), full_path
+
+
+def write_reproducible_zip(archive_path, root, entries):
+    with zipfile.ZipFile(archive_path, "w", zipfile.ZIP_DEFLATED) as z:
+        for relative_path, mode in entries:
+            info = zipfile.ZipInfo(relative_path, date_time=ZIP_DATE_TIME)
+            info.compress_type = zipfile.ZIP_DEFLATED
+            info.create_system = 3
+            info.external_attr = (stat.S_IFREG | mode) << 16
+            with open(os.path.join(root, relative_path), "rb") as src, z.open(info, "w") as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+
+
+class FunctionArchiveCache:
+    """On-disk cache of function archives keyed by a digest of the function root.
+
+    The digest covers sorted relative paths, file modes and contents, so it only
+    changes when the tree does. Per-file content digests are memoized by
+    inode, mtime and size; archives are built with fixed timestamps so the same
+    tree always produces the same bytes.
+
+    Digests of files that were removed from a root, or whose root is gone, are
+    dropped once per run. The mtime of an archive is its last use, which
+    prune_archives evicts by.
+    Uploaded keys are trusted for UPLOADED_MAX_AGE and then checked on S3 again,
+    as the bucket may have expired them in the meantime.
+    """
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir or default_cache_dir()
+        self.archives_dir = os.path.join(self.cache_dir, "archives")
+        self.file_digests_path = os.path.join(self.cache_dir, "file-digests.json")
+        self.uploaded_path = os.path.join(self.cache_dir, "uploaded.json")
+        self.lock = threading.Lock()
+        self.file_digests = load_json(self.file_digests_path)
+        self.scanned = set()
+        self.uploaded = load_json(self.uploaded_path)
+
+    def get_file_digest(self, full_path, st):
+        key = os.path.abspath(full_path)
+        signature = [st.st_ino, st.st_mtime_ns, st.st_size]
+        with self.lock:
+            self.scanned.add(key)
+            cached = self.file_digests.get(key)
+        if cached and cached[:3] == signature:
+            return cached[3]
+
+        digest = file_sha256(full_path)
+        with self.lock:
+            self.file_digests[key] = signature + [digest]
+        return digest
+
+    def scan(self, root):
+        """Return the tree digest of root and its (relative_path, mode) entries."""
+        hasher = hashlib.sha256()
+        entries = []
+        for relative_path, full_path in list_tree(root):
+            st = os.stat(full_path)
+            mode = stat.S_IMODE(st.st_mode)
+            hasher.update("{}\0{:o}\0{}\n".format(relative_path, mode,
+                                                   self.get_file_digest(full_path, st)).encode())
+            entries.append((relative_path, mode))
+        return hasher.hexdigest(), entries
+
+    def get_scanned_file_digests(self):
+        with self.lock:
+            return {k: self.file_digests[k] for k in self.scanned}
+
+    def update_file_digests(self, root, file_digests):
+        """Replace the digests under root with those of its latest scan."""
+        prefix = os.path.join(os.path.abspath(root), "")
+        with self.lock:
+            for k in [k for k in self.file_digests if k.startswith(prefix) and k not in file_digests]:
+                del self.file_digests[k]
+            self.file_digests.update(file_digests)
+
+    def save_file_digests(self):
+        with self.lock:
+            # roots of other checkouts, such as per-job CI workspaces, may be gone by now
+            for k in [k for k in self.file_digests if not os.path.exists(k)]:
+                del self.file_digests[k]
+            save_json(self.file_digests_path, self.file_digests)
+
+    def build_archive(self, root):
+        """Return (archive_path, digest), building the archive only if the tree changed."""
+        root = os.path.abspath(root)
+        digest, entries = self.scan(root)
+        archive_path = os.path.join(self.archives_dir, "{}.zip".format(digest))
+        try:
+            os.utime(archive_path)
+        except FileNotFoundError:
+            os.makedirs(self.archives_dir, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=self.archives_dir, suffix=".zip.tmp")
+            os.close(fd)
+            try:
+                write_reproducible_zip(temp_path, root, entries)
+                os.replace(temp_path, archive_path)
+            finally:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+        return archive_path, digest
+
+    def prune_archives(self, max_age=ARCHIVE_MAX_AGE, max_count=ARCHIVE_MAX_COUNT):
+        """Remove archives unused for max_age seconds and all but the max_count most recently used."""
+        try:
+            names = os.listdir(self.archives_dir)
+        except FileNotFoundError:
+            return
+
+        now = time.time()
+        archives = []
+        for name in names:
+            path = os.path.join(self.archives_dir, name)
+            try:
+                mtime = os.stat(path).st_mtime
+            except FileNotFoundError:
+                continue
+            if name.endswith(".zip"):
+                archives.append((mtime, path))
+            elif now - mtime > TEMP_ARCHIVE_MAX_AGE:
+                # left over by a build that was killed
+                self.remove_file(path)
+
+        archives.sort(reverse=True)
+        for i, (mtime, path) in enumerate(archives):
+            if i >= max_count or now - mtime > max_age:
+                self.remove_file(path)
+
+    def remove_file(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def is_uploaded(self, bucket_name, key_name):
+        with self.lock:
+            uploaded_at = self.uploaded.get(bucket_name, {}).get(key_name)
+        return uploaded_at is not None and time.time() - uploaded_at < UPLOADED_MAX_AGE
+
+    def mark_uploaded(self, bucket_name, key_name):
+        now = time.time()
+        with self.lock:
+            self.uploaded.setdefault(bucket_name, {})[key_name] = now
+            for bucket, keys in list(self.uploaded.items()):
+                for k in [k for k, uploaded_at in keys.items() if now - uploaded_at >= UPLOADED_MAX_AGE]:
+                    del keys[k]
+                if not keys:
+                    del self.uploaded[bucket]
+            save_json(self.uploaded_path, self.uploaded)
+
+
+def build_archive_in_worker(cache_dir, root):
+    cache = FunctionArchiveCache(cache_dir)
+    archive_path, digest = cache.build_archive(root)
+    return archive_path, digest, cache.get_scanned_file_digests()
+
+
+class FunctionPackager:
+    """Packages and uploads each function root once per run.
+
+    Stacks sharing a FunctionRoot await the same future. Archives are built in a
+    process pool so that several large roots are zipped on separate cores.
+    """
+
+    def __init__(self, archive_cache, max_workers=None):
+        self.archive_cache = archive_cache
+        self.max_workers = max_workers
+        self.pool = None
+        self.archive_futures = {}
+        self.upload_futures = {}
+
+    def get_pool(self):
+        if self.pool is None:
+            # the AWS executor threads may be holding locks that a forked worker would inherit held,
+            # so workers are spawned (mp_context is Python 3.7+)
+            if sys.version_info >= (3, 7):
+                self.pool = ProcessPoolExecutor(max_workers=self.max_workers,
+                                                mp_context=multiprocessing.get_context("spawn"))
+            else:
+                self.pool = ProcessPoolExecutor(max_workers=self.max_workers)
+        return self.pool
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+            # archives were built or touched in this run, so the cache is saved and pruned once afterwards
+            self.archive_cache.save_file_digests()
+            self.archive_cache.prune_archives()
+
+    async def build_archive(self, root):
+        loop = asyncio.get_event_loop()
+        archive_path, digest, file_digests = await loop.run_in_executor(
+            self.get_pool(), build_archive_in_worker, self.archive_cache.cache_dir, root)
+        self.archive_cache.update_file_digests(root, file_digests)
+        return archive_path, digest
+
+    def get_archive(self, function_root):
+        root = os.path.abspath(function_root)
+        if root not in self.archive_futures:
+            self.archive_futures[root] = asyncio.ensure_future(self.build_archive(root))
+        return self.archive_futures[root]
+
+    async def check_file_exists(self, s3, bucket_name, key_name):
+        try:
+            await run_blocking(s3.head_object, Bucket=bucket_name, Key=key_name)
+            return True
+        except botocore.exceptions.ClientError:
+            return False
+
+    async def upload_archive(self, s3, bucket_name, function_root):
+        archive_path, digest = await self.get_archive(function_root)
+        key_name = "function/{}.zip".format(digest)
+        if self.archive_cache.is_uploaded(bucket_name, key_name):
+            return key_name
+
+        if not await self.check_file_exists(s3, bucket_name, key_name):
+            await run_blocking(s3.upload_file, archive_path, bucket_name, key_name)
+        self.archive_cache.mark_uploaded(bucket_name, key_name)
+
+        return key_name
+
+    def upload(self, s3, bucket_name, function_root):
+        """Return a shared future of the S3 key of the function root's archive."""
+        key = (bucket_name, os.path.abspath(function_root))
+        if key not in self.upload_futures:
+            self.upload_futures[key] = asyncio.ensure_future(self.upload_archive(s3, bucket_name, function_root))
+        return self.upload_futures[key]
@@ -0,0 +1,26 @@
+import os
+import json
+import tempfile
+
+
+def default_cache_dir():
+    return os.environ.get("STACKLIFT_CACHE_DIR") or \
+        os.path.join(os.path.expanduser("~"), ".cache", "stacklift")
+
+
+def load_json(path, default=None):
+    try:
+        with open(path) as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return {} if default is None else default
+
+
+def save_json(path, value):
+    """Write JSON atomically so that concurrent readers never see a partial file."""
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory)
+    with os.fdopen(fd, "w") as fp:
+        json.dump(value, fp)
+    os.replace(temp_path, path)
@@ -0,0 +1,177 @@
+import os
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+try:
+    import contextvars
+except ImportError:
+    contextvars = None
+
+CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STACK_DURATION_BUCKETS = (10.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1200.0, 1800.0, 3600.0)
+
+# the stack a task works on, so that API calls made on its behalf are labelled with it
+_current_stack = contextvars.ContextVar("stacklift_stack", default="") if contextvars else None
+
+
+def set_current_stack(name):
+    if _current_stack:
+        _current_stack.set(name)
+
+
+def get_current_stack():
+    return _current_stack.get() if _current_stack else ""
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = ('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+               for k, v in labels)
+    return "{" + ",".join(escaped) + "}"
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+
+class MetricFamily:
+    def __init__(self, name, type, help, buckets=None):
+        self.name = name
+        self.type = type
+        self.help = help
+        self.buckets = buckets
+        self.samples = {}
+
+    def key(self, labels):
+        return tuple(sorted(labels.items()))
+
+    def inc(self, labels, amount=1):
+        key = self.key(labels)
+        self.samples[key] = self.samples.get(key, 0) + amount
+
+    def set(self, labels, value):
+        self.samples[self.key(labels)] = value
+
+    def observe(self, labels, value):
+        key = self.key(labels)
+        if key not in self.samples:
+            self.samples[key] = Histogram(self.buckets)
+        self.samples[key].observe(value)
+
+    def format(self):
+        lines = ["# TYPE {} {}".format(self.name, self.type), "# HELP {} {}".format(self.name, self.help)]
+        for labels, value in sorted(self.samples.items()):
+            if self.type == "counter":
+                lines.append("{}_total{} {}".format(self.name, format_labels(labels), format_value(value)))
+            elif self.type == "gauge":
+                lines.append("{}{} {}".format(self.name, format_labels(labels), format_value(value)))
+            else:
+                for bound, count in zip(value.buckets, value.counts):
+                    lines.append("{}_bucket{} {}".format(self.name, format_labels(labels + (("le", bound),)), count))
+                lines.append("{}_bucket{} {}".format(self.name, format_labels(labels + (("le", "+Inf"),)),
+                                                     value.count))
+                lines.append("{}_count{} {}".format(self.name, format_labels(labels), value.count))
+                lines.append("{}_sum{} {}".format(self.name, format_labels(labels), format_value(value.sum)))
+        return lines
+
+
+class Metrics:
+    """Counters, gauges and histograms of a run, rendered in the OpenMetrics text format."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.api_calls = MetricFamily("stacklift_api_calls", "counter", "AWS API calls, retries included.")
+        self.api_retries = MetricFamily("stacklift_api_retries", "counter", "AWS API calls retried after throttling or transient errors.")
+        self.api_throttles = MetricFamily("stacklift_api_throttles", "counter", "AWS API calls that were throttled.")
+        self.api_latency = MetricFamily("stacklift_api_latency_seconds", "histogram",
+                                        "Latency of single AWS API calls.", LATENCY_BUCKETS)
+        self.stacks_in_flight = MetricFamily("stacklift_stacks_in_flight", "gauge", "Stacks being deployed.")
+        self.stack_duration = MetricFamily("stacklift_stack_duration_seconds", "gauge",
+                                           "Deploy duration of each stack by its result.")
+        self.stack_durations = MetricFamily("stacklift_stack_status_duration_seconds", "histogram",
+                                            "Deploy durations of stacks by their result.", STACK_DURATION_BUCKETS)
+        self.families = [self.api_calls, self.api_retries, self.api_throttles, self.api_latency,
+                         self.stacks_in_flight, self.stack_duration, self.stack_durations]
+        self.stacks_in_flight.set({}, 0)
+
+    def observe_api_call(self, service_name, operation_name, region_name, latency, throttled, retry):
+        labels = {"service": service_name, "operation": operation_name, "region": region_name or "",
+                  "stack": get_current_stack()}
+        with self.lock:
+            self.api_calls.inc(labels)
+            self.api_latency.observe(labels, latency)
+            if throttled:
+                self.api_throttles.inc(labels)
+            if retry:
+                self.api_retries.inc(labels)
+
+    def start_stack(self):
+        with self.lock:
+            self.stacks_in_flight.inc({})
+
+    def finish_stack(self, stack, status, duration):
+        with self.lock:
+            self.stacks_in_flight.inc({}, -1)
+            self.stack_duration.set({"stack": stack, "status": status}, duration)
+            self.stack_durations.observe({"status": status}, duration)
+
+    def format(self):
+        with self.lock:
+            lines = [line for family in self.families for line in family.format()]
+        return "\n".join(lines + ["# EOF", ""])
+
+    def write_textfile(self, path):
+        """Write atomically, as textfile collectors may read the file at any time."""
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, temp_path = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, "w") as fp:
+            fp.write(self.format())
+        os.replace(temp_path, path)
+
+    def serve(self, port, host="127.0.0.1"):
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.format().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer((host, port), Handler)
+        thread = threading.Thread(target=server.serve_forever, name="stacklift-metrics", daemon=True)
+        thread.start()
+        return server
+
+
+_metrics = None
+
+
+def get_metrics():
+    global _metrics
+    if _metrics is None:
+        _metrics = Metrics()
+    return _metrics
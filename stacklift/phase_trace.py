@@ -0,0 +1,70 @@
+import json
+import time
+from contextlib import contextmanager
+
+
+class PhaseSpan:
+    def __init__(self, stack, phase, start, end):
+        self.stack = stack
+        self.phase = phase
+        self.start = start
+        self.end = end
+
+    def get_duration(self):
+        return self.end - self.start
+
+
+class PhaseTrace:
+    """Timeline of the phases every stack of a run went through, on the monotonic clock."""
+
+    def __init__(self):
+        self.origin = time.monotonic()
+        self.spans = []
+
+    def add(self, stack, phase, start, end):
+        self.spans.append(PhaseSpan(stack, phase, start, end))
+
+    @contextmanager
+    def span(self, stack, phase):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(stack, phase, start, time.monotonic())
+
+    def get_phase_durations(self, stack):
+        durations = {}
+        for span in self.spans:
+            if span.stack == stack:
+                durations[span.phase] = durations.get(span.phase, 0.0) + span.get_duration()
+        return durations
+
+    def to_chrome_trace(self):
+        """The spans in Chrome's trace event format, one row per stack (chrome://tracing, Perfetto)."""
+        stacks = []
+        for span in self.spans:
+            if span.stack not in stacks:
+                stacks.append(span.stack)
+
+        events = [{"name": "thread_name", "ph": "M", "pid": 1, "tid": i, "args": {"name": stack}}
+                  for i, stack in enumerate(stacks)]
+        for span in sorted(self.spans, key=lambda x: x.start):
+            events.append({"name": span.phase, "cat": "stack", "ph": "X", "pid": 1,
+                           "tid": stacks.index(span.stack),
+                           "ts": int((span.start - self.origin) * 1e6),
+                           "dur": int(span.get_duration() * 1e6),
+                           "args": {"stack": span.stack}})
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def save(self, path):
+        with open(path, "w") as fp:
+            json.dump(self.to_chrome_trace(), fp)
+
+
+@contextmanager
+def trace_span(trace, stack, phase):
+    if trace is None:
+        yield
+    else:
+        with trace.span(stack, phase):
+            yield
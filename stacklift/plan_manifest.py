@@ -0,0 +1,29 @@
+import json
+import datetime
+from collections import OrderedDict
+from stacklift.cfn_deploy import ChangeSetReference
+
+
+class PlanManifest:
+    """Change sets and deletions planned by `stacklift plan`, saved so that `stacklift apply` can carry them out."""
+
+    def __init__(self, group_name, change_sets, created_at=None):
+        self.group_name = group_name
+        self.change_sets = change_sets
+        self.created_at = created_at or "{:%Y-%m-%dT%H:%M:%SZ}".format(datetime.datetime.utcnow())
+
+    def save(self, path):
+        with open(path, "w") as fp:
+            json.dump({
+                "GroupName": self.group_name,
+                "CreatedAt": self.created_at,
+                "ChangeSets": OrderedDict((name, x.to_dict()) for name, x in self.change_sets.items())
+            }, fp, indent=2)
+
+
+def load_plan_manifest(path):
+    with open(path) as fp:
+        value = json.load(fp, object_pairs_hook=OrderedDict)
+
+    change_sets = OrderedDict((name, ChangeSetReference.from_dict(x)) for name, x in value["ChangeSets"].items())
+    return PlanManifest(value["GroupName"], change_sets, value["CreatedAt"])
@@ -0,0 +1,150 @@
+import time
+import random
+import asyncio
+import logging
+import botocore
+from stacklift.aws_executor import run_blocking
+from stacklift.metrics import get_metrics
+
+logger = logging.getLogger(__name__)
+
+THROTTLING_ERROR_CODES = {
+    "Throttling",
+    "ThrottlingException",
+    "RequestLimitExceeded",
+    "TooManyRequestsException",
+    "SlowDown",
+}
+
+# (requests per second, burst) per service, with overrides for mutating APIs
+DEFAULT_RATES = {
+    "cloudformation": (5.0, 10),
+}
+OPERATION_RATES = {
+    ("cloudformation", "create_change_set"): (1.0, 5),
+    ("cloudformation", "execute_change_set"): (1.0, 5),
+    ("cloudformation", "delete_stack"): (1.0, 5),
+    ("cloudformation", "list_exports"): (2.0, 5),
+}
+
+
+def is_throttling_error(ex):
+    return isinstance(ex, botocore.exceptions.ClientError) and \
+        ex.response.get("Error", {}).get("Code") in THROTTLING_ERROR_CODES
+
+
+def is_transient_error(ex):
+    """Whether a failed call may succeed when made again: throttling, server and connection errors."""
+    if isinstance(ex, botocore.exceptions.ClientError):
+        return is_throttling_error(ex) or ex.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0) >= 500
+    return isinstance(ex, (botocore.exceptions.ConnectionError, botocore.exceptions.HTTPClientError))
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def reserve(self):
+        """Take a token and return how long the caller has to wait before using it."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return max(0.0, -self.tokens / self.rate)
+
+
+class ApiStats:
+    def __init__(self):
+        self.calls = 0
+        self.throttles = 0
+        self.wait_time = 0.0
+
+
+class RateGovernor:
+    """Spreads AWS API calls over per-(service, operation, region) token buckets.
+
+    Throttling errors that still get through, server errors and connection
+    errors are retried with exponential backoff. Clients of
+    AwsClients.GOVERNED_SERVICES make a single attempt per call, so every retry
+    of their calls is made and counted here.
+    """
+
+    def __init__(self, max_retries=8, retry_base_delay=1.0, retry_max_delay=30.0):
+        self.max_retries = max_retries
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self.buckets = {}
+        self.stats = {}
+
+    def get_bucket(self, service_name, operation_name, region_name):
+        key = (service_name, operation_name, region_name)
+        if key not in self.buckets:
+            rate = OPERATION_RATES.get((service_name, operation_name)) or DEFAULT_RATES.get(service_name)
+            self.buckets[key] = TokenBucket(*rate) if rate else None
+        return self.buckets[key]
+
+    def get_stats(self, service_name, operation_name, region_name):
+        key = (service_name, operation_name, region_name)
+        if key not in self.stats:
+            self.stats[key] = ApiStats()
+        return self.stats[key]
+
+    async def call(self, client, operation_name, **kwargs):
+        service_name = client.meta.service_model.service_name
+        region_name = client.meta.region_name
+        bucket = self.get_bucket(service_name, operation_name, region_name)
+        stats = self.get_stats(service_name, operation_name, region_name)
+
+        attempt = 0
+        while True:
+            delay = bucket.reserve() if bucket else 0.0
+            if delay > 0:
+                stats.wait_time += delay
+                await asyncio.sleep(delay)
+
+            stats.calls += 1
+            started = time.monotonic()
+            throttled = False
+            try:
+                return await run_blocking(getattr(client, operation_name), **kwargs)
+            except (botocore.exceptions.ClientError, botocore.exceptions.ConnectionError,
+                    botocore.exceptions.HTTPClientError) as ex:
+                throttled = is_throttling_error(ex)
+                if not is_transient_error(ex) or attempt >= self.max_retries:
+                    raise
+                if throttled:
+                    stats.throttles += 1
+            finally:
+                get_metrics().observe_api_call(service_name, operation_name, region_name,
+                                               time.monotonic() - started, throttled, attempt > 0)
+
+            delay = min(self.retry_max_delay, self.retry_base_delay * 2 ** attempt) * random.uniform(0.5, 1.0)
+            stats.wait_time += delay
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    def format_stats(self):
+        lines = ["{:<16} {:<12} {:<24} {:>6} {:>9} {:>9}".format(
+            "service", "region", "operation", "calls", "throttles", "wait (s)")]
+        for (service_name, operation_name, region_name), stats in sorted(self.stats.items(),
+                                                                         key=lambda x: tuple(map(str, x[0]))):
+            lines.append("{:<16} {:<12} {:<24} {:>6} {:>9} {:>9.1f}".format(
+                service_name, region_name or "-", operation_name, stats.calls, stats.throttles, stats.wait_time))
+        return "\n".join(lines)
+
+
+_governor = None
+
+
+def get_governor():
+    global _governor
+    if _governor is None:
+        _governor = RateGovernor()
+    return _governor
+
+
+async def call_api(client, operation_name, **kwargs):
+    return await get_governor().call(client, operation_name, **kwargs)
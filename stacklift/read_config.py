@@ -1,9 +1,17 @@
 #!/usr/bin/env python3
 
+import os
+import threading
+import functools
 import yaml
 from collections import OrderedDict
 
-def yaml_ordered_load(stream, Loader=yaml.Loader, object_pairs_hook=OrderedDict):
+# libyaml is several times faster than the pure-Python loader
+DEFAULT_LOADER = getattr(yaml, "CLoader", yaml.Loader)
+
+
+@functools.lru_cache(maxsize=None)
+def ordered_loader(Loader, object_pairs_hook):
     class OrderedLoader(Loader):
         pass
     def construct_mapping(loader, node):
@@ -12,14 +20,62 @@ def yaml_ordered_load(stream, Loader=yaml.Loader, object_pairs_hook=OrderedDict)
     OrderedLoader.add_constructor(
         yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG,
         construct_mapping)
-    return yaml.load(stream, OrderedLoader)
+    return OrderedLoader
+
+
+def yaml_ordered_load(stream, Loader=DEFAULT_LOADER, object_pairs_hook=OrderedDict):
+    return yaml.load(stream, ordered_loader(Loader, object_pairs_hook))
+
+
+class FrozenOrderedDict(OrderedDict):
+    def __init__(self, pairs=()):
+        for key, value in pairs:
+            OrderedDict.__setitem__(self, key, value)
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError("Parsed config is read-only")
+
+    __setitem__ = __delitem__ = _read_only
+    clear = pop = popitem = setdefault = update = move_to_end = _read_only
+
+    def copy(self):
+        return OrderedDict(self)
+
+    def __reduce__(self):
+        return self.__class__, (list(self.items()),)
+
+
+def freeze(value):
+    if isinstance(value, dict):
+        return FrozenOrderedDict((k, freeze(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+_config_cache = {}
+_config_cache_lock = threading.Lock()
+
+
+def load_config(filename):
+    """Parse a config file once per process; the result is shared and read-only."""
+    path = os.path.abspath(filename)
+    mtime = os.stat(path).st_mtime_ns
+    with _config_cache_lock:
+        cached = _config_cache.get(path)
+        if cached and cached[0] == mtime:
+            return cached[1]
+
+        with open(path) as f:
+            config = freeze(yaml_ordered_load(f))
+        _config_cache[path] = (mtime, config)
+        return config
 
 
 class ConfigReader:
     def __init__(self, filename):
         self.config_path = filename
-        with open(filename) as f:
-            self.config = yaml_ordered_load(f)
+        self.config = load_config(filename)
         self.sections = {}
 
         common = self.config.get("Common") or {}
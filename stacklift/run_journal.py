@@ -0,0 +1,70 @@
+import os
+import json
+import time
+import hashlib
+from enum import Enum
+from stacklift.local_state import default_cache_dir
+
+
+class RunPhase(Enum):
+    PACKAGED = "packaged"
+    CHANGESET_CREATED = "changeset_created"
+    EXECUTING = "executing"
+    COMPLETED = "completed"
+    FAILED = "failed"
+
+
+class RunJournal:
+    """Append-only log of the phases each stack of a group deploy went through.
+
+    A new run starts a new journal. A resumed run reads the last phase of every
+    stack from the previous runs and keeps appending to the same file.
+    """
+
+    def __init__(self, scope, cache_dir=None, resume=False):
+        name = hashlib.sha256(scope.encode()).hexdigest()[:16]
+        self.path = os.path.join(cache_dir or default_cache_dir(), "journal", "{}.jsonl".format(name))
+        self.previous = self.load() if resume else {}
+        if not resume and os.path.exists(self.path):
+            os.remove(self.path)
+
+    def load(self):
+        previous = {}
+        try:
+            with open(self.path) as fp:
+                for line in fp:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # the last line may be cut short if the previous run died while writing it
+                        continue
+                    # a failure says nothing about where the stack is, so the phase before it is kept
+                    if entry["phase"] != RunPhase.FAILED.value:
+                        previous[entry["stack"]] = entry
+        except OSError:
+            pass
+        return previous
+
+    def record(self, stack, phase, **fields):
+        entry = dict(fields, time=time.time(), stack=stack, phase=phase.value)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, "a") as fp:
+            fp.write(json.dumps(entry) + "\n")
+            fp.flush()
+            os.fsync(fp.fileno())
+
+    def for_stack(self, stack):
+        return StackJournal(self, stack)
+
+
+class StackJournal:
+    def __init__(self, journal, stack):
+        self.journal = journal
+        self.stack = stack
+        self.previous = journal.previous.get(stack)
+
+    def get_previous_phase(self):
+        return RunPhase(self.previous["phase"]) if self.previous else None
+
+    def record(self, phase, **fields):
+        self.journal.record(self.stack, phase, **fields)
@@ -0,0 +1,132 @@
+import io
+import os
+import time
+import random
+import base64
+import hashlib
+import botocore
+from collections import deque
+from stacklift.aws_executor import get_executor
+from stacklift.rate_governor import is_transient_error
+
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+DEFAULT_MAX_CONCURRENCY = 8
+
+
+class RangedObjectReader(io.RawIOBase):
+    """Reads an S3 object front to back while the following parts are fetched with parallel ranged GETs.
+
+    At most `max_concurrency` parts are held in memory at a time. Every GET is
+    made with the ETag seen by the caller, so an object replaced mid-download
+    fails instead of mixing two versions.
+    """
+
+    def __init__(self, s3, bucket, key, size, etag, part_size=DEFAULT_PART_SIZE,
+                 max_concurrency=DEFAULT_MAX_CONCURRENCY):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.etag = etag
+        self.max_concurrency = max_concurrency
+        self.ranges = deque((start, min(start + part_size, size) - 1) for start in range(0, size, part_size))
+        self.pending = deque()
+        self.buffer = b""
+        self.offset = 0
+
+    def readable(self):
+        return True
+
+    def fetch(self, start, end):
+        response = self.s3.get_object(Bucket=self.bucket, Key=self.key, IfMatch=self.etag,
+                                      Range="bytes={}-{}".format(start, end))
+        return response["Body"].read()
+
+    def fill(self):
+        while self.ranges and len(self.pending) < self.max_concurrency:
+            self.pending.append(get_executor().submit(self.fetch, *self.ranges.popleft()))
+
+    def readinto(self, b):
+        while self.offset >= len(self.buffer):
+            self.fill()
+            if not self.pending:
+                return 0
+            self.buffer = self.pending.popleft().result()
+            self.offset = 0
+
+        n = min(len(b), len(self.buffer) - self.offset)
+        b[:n] = self.buffer[self.offset:self.offset + n]
+        self.offset += n
+        return n
+
+    def close(self):
+        for future in self.pending:
+            future.cancel()
+        self.pending.clear()
+        super().close()
+
+
+MIN_PART_SIZE = 5 * 1024 * 1024
+PART_ATTEMPTS = 5
+PART_RETRY_BASE_DELAY = 1.0
+PART_RETRY_MAX_DELAY = 20.0
+# the part was corrupted or stalled on the way, so sending it again can succeed
+PART_RETRY_ERROR_CODES = {"BadDigest", "RequestTimeout"}
+
+
+def md5_base64(data):
+    return base64.b64encode(hashlib.md5(data).digest()).decode()
+
+
+def read_part(path, start, size):
+    with open(path, "rb") as fp:
+        fp.seek(start)
+        return fp.read(size)
+
+
+def upload_part(s3, bucket, key, upload_id, part_number, path, start, size):
+    data = read_part(path, start, size)
+    # Content-MD5 rather than the newer checksum parameters, which the locked botocore does not know yet
+    checksum = md5_base64(data)
+    for attempt in range(PART_ATTEMPTS):
+        try:
+            response = s3.upload_part(Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=part_number,
+                                      Body=data, ContentMD5=checksum)
+            return {"PartNumber": part_number, "ETag": response["ETag"]}
+        except (botocore.exceptions.ClientError, botocore.exceptions.BotoCoreError) as ex:
+            retryable = is_transient_error(ex) or (isinstance(ex, botocore.exceptions.ClientError) and
+                                                   ex.response.get("Error", {}).get("Code") in PART_RETRY_ERROR_CODES)
+            if not retryable or attempt == PART_ATTEMPTS - 1:
+                raise
+        time.sleep(min(PART_RETRY_MAX_DELAY, PART_RETRY_BASE_DELAY * 2 ** attempt) * random.uniform(0.5, 1.0))
+
+
+def upload_file_multipart(s3, bucket, key, path, metadata=None, part_size=DEFAULT_PART_SIZE,
+                          max_concurrency=DEFAULT_MAX_CONCURRENCY):
+    """Upload a file as concurrent parts, each verified by S3 against its MD5."""
+    if part_size < MIN_PART_SIZE:
+        raise RuntimeError("Part size must be at least {} bytes".format(MIN_PART_SIZE))
+
+    size = os.path.getsize(path)
+    if size <= part_size:
+        data = read_part(path, 0, size)
+        s3.put_object(Bucket=bucket, Key=key, Body=data, Metadata=metadata or {}, ContentMD5=md5_base64(data))
+        return
+
+    upload_id = s3.create_multipart_upload(Bucket=bucket, Key=key, Metadata=metadata or {})["UploadId"]
+    try:
+        ranges = [(i + 1, start, min(part_size, size - start)) for i, start in enumerate(range(0, size, part_size))]
+        parts = []
+        pending = deque()
+        for part_number, start, length in ranges:
+            # bounded, so that no more than max_concurrency parts are read into memory at once
+            if len(pending) >= max_concurrency:
+                parts.append(pending.popleft().result())
+            pending.append(get_executor().submit(upload_part, s3, bucket, key, upload_id,
+                                                 part_number, path, start, length))
+        parts.extend(future.result() for future in pending)
+
+        s3.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id,
+                                     MultipartUpload={"Parts": parts})
+    except:
+        s3.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        raise
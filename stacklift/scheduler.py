@@ -0,0 +1,106 @@
+import os
+import time
+import heapq
+import asyncio
+from stacklift.local_state import default_cache_dir, load_json, save_json
+
+
+class DurationHistory:
+    """Smoothed per-stack deploy durations from previous runs, used as scheduling weights."""
+
+    SMOOTHING = 0.5
+
+    def __init__(self, scope, cache_dir=None):
+        self.scope = scope
+        self.path = os.path.join(cache_dir or default_cache_dir(), "durations.json")
+        self.durations = load_json(self.path)
+
+    def key(self, name):
+        return "{}:{}".format(self.scope, name)
+
+    def get_weights(self, names):
+        known = {x: self.durations[self.key(x)] for x in names if self.key(x) in self.durations}
+        if not known:
+            return None
+
+        default = sum(known.values()) / len(known)
+        return {x: known.get(x, default) for x in names}
+
+    def record(self, name, duration):
+        previous = self.durations.get(self.key(name))
+        if previous is not None:
+            duration = self.SMOOTHING * duration + (1 - self.SMOOTHING) * previous
+        self.durations[self.key(name)] = duration
+
+    def save(self):
+        # re-read so that runs of other groups sharing the file are not lost
+        durations = load_json(self.path)
+        durations.update({k: v for k, v in self.durations.items() if k.startswith(self.scope + ":")})
+        save_json(self.path, durations)
+
+
+class DeployScheduler:
+    """Runs the stacks of a dependency graph with bounded concurrency.
+
+    A stack becomes ready once every stack it depends on has finished. Ready stacks
+    start in order of their longest remaining downstream path, so the slowest
+    chains get going first.
+    """
+
+    def __init__(self, dependency_graph, run_stack, max_parallel=None, weights=None):
+        self.dependency_graph = dependency_graph
+        self.run_stack = run_stack
+        self.max_parallel = max_parallel
+        self.priorities = dependency_graph.downstream_lengths(weights)
+        self.durations = {}
+        self.started = None
+        self.ready_times = {}
+        self.start_times = {}
+
+    async def run_timed(self, name, depend_results):
+        self.start_times[name] = time.monotonic()
+        try:
+            return await self.run_stack(name, depend_results)
+        finally:
+            self.durations[name] = time.monotonic() - self.start_times[name]
+
+    async def run(self, names=None):
+        graph = self.dependency_graph
+        names = set(graph.get_names() if names is None else names)
+        position = {name: i for i, name in enumerate(graph.order)}
+        remaining = {name: len([x for x in graph.depends[name] if x in names]) for name in names}
+
+        ready = []
+        def push(name):
+            self.ready_times[name] = time.monotonic()
+            heapq.heappush(ready, (-self.priorities[name], position[name], name))
+
+        self.started = time.monotonic()
+
+        for name in names:
+            if remaining[name] == 0:
+                push(name)
+
+        results = {}
+        running = {}
+        try:
+            while ready or running:
+                while ready and (not self.max_parallel or len(running) < self.max_parallel):
+                    _, _, name = heapq.heappop(ready)
+                    depend_results = [results[x] for x in graph.depends[name] if x in names]
+                    running[asyncio.ensure_future(self.run_timed(name, depend_results))] = name
+
+                done, _ = await asyncio.wait(list(running), return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    results[name] = future.result()
+                    for dependent in graph.dependents[name]:
+                        if dependent in names:
+                            remaining[dependent] -= 1
+                            if remaining[dependent] == 0:
+                                push(dependent)
+        finally:
+            for future in running:
+                future.cancel()
+
+        return results
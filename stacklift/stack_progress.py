@@ -0,0 +1,95 @@
+import time
+import random
+import asyncio
+
+SUCCESS_STATUSES = {
+    "CREATE": "CREATE_COMPLETE",
+    "UPDATE": "UPDATE_COMPLETE",
+    "DELETE": "DELETE_COMPLETE",
+}
+
+FAILURE_STATUSES = {
+    "CREATE_FAILED",
+    "ROLLBACK_COMPLETE",
+    "ROLLBACK_FAILED",
+    "UPDATE_FAILED",
+    "UPDATE_ROLLBACK_COMPLETE",
+    "UPDATE_ROLLBACK_FAILED",
+    "DELETE_FAILED",
+    "IMPORT_ROLLBACK_COMPLETE",
+    "IMPORT_ROLLBACK_FAILED",
+}
+
+
+class Backoff:
+    """Poll delays that start short and stretch while nothing happens.
+
+    Progress shrinks the delay again; every delay gets a random jitter so that
+    concurrent stacks do not poll in lockstep.
+    """
+
+    def __init__(self, initial, maximum, factor=1.5, jitter=0.2):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.jitter = jitter
+        self.delay = initial
+
+    def next_delay(self, progressed=False):
+        delay = self.delay
+        if progressed:
+            self.delay = max(self.initial, self.delay / self.factor)
+        else:
+            self.delay = min(self.maximum, self.delay * self.factor)
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    async def sleep(self, progressed=False):
+        await asyncio.sleep(self.next_delay(progressed))
+
+
+class StackProgressTracker:
+    """Follows a stack operation through its events.
+
+    Only events newer than the cursor are fetched on each poll, and the operation
+    is complete once the stack's own terminal event shows up among them.
+    """
+
+    def __init__(self, deployer, stack_id, last_event_id, backoff, timeout):
+        self.deployer = deployer
+        self.stack_id = stack_id
+        self.last_event_id = last_event_id
+        self.backoff = backoff
+        self.timeout = timeout
+
+    def is_stack_event(self, event):
+        return event["ResourceType"] == "AWS::CloudFormation::Stack" and \
+            event.get("PhysicalResourceId", self.stack_id) == self.stack_id and \
+            event["LogicalResourceId"] == self.deployer.stack_name
+
+    async def poll(self):
+        events = await self.deployer.get_stack_events_until(self.stack_id, self.last_event_id)
+        if events:
+            self.last_event_id = events[0]["EventId"]
+            self.deployer.print_stack_events(events)
+        return events
+
+    async def wait(self, operation):
+        success_status = SUCCESS_STATUSES[operation]
+        deadline = time.monotonic() + self.timeout
+        progressed = False
+        while time.monotonic() < deadline:
+            await self.backoff.sleep(progressed)
+            events = await self.poll()
+            progressed = bool(events)
+
+            for event in reversed(events):
+                if not self.is_stack_event(event):
+                    continue
+
+                status = event["ResourceStatus"]
+                if status == success_status:
+                    return
+                if status in FAILURE_STATUSES:
+                    raise RuntimeError("Stack operation failed: {0}".format(status))
+
+        raise RuntimeError("Timed out waiting for {0}".format(success_status))
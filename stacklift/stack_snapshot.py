@@ -0,0 +1,58 @@
+import asyncio
+from stacklift.rate_governor import call_api
+
+
+class StackSnapshot:
+    """Every stack of one region, described once with a paginated describe_stacks.
+
+    Deployers read stack state from here instead of describing each stack, and
+    write back what they learn as their stacks change.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.lock = None
+        self.stacks = None
+
+    async def load(self):
+        stacks = {}
+        args = {}
+        while True:
+            response = await call_api(self.client, "describe_stacks", **args)
+            for stack in response["Stacks"]:
+                stacks[stack["StackName"]] = stack
+
+            if not response.get("NextToken"):
+                break
+            args["NextToken"] = response["NextToken"]
+        self.stacks = stacks
+
+    async def get(self, stack_name):
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+
+        async with self.lock:
+            if self.stacks is None:
+                await self.load()
+        return self.stacks.get(stack_name)
+
+    def update(self, stack):
+        if self.stacks is not None:
+            self.stacks[stack["StackName"]] = stack
+
+    def remove(self, stack_name):
+        if self.stacks is not None:
+            self.stacks.pop(stack_name, None)
+
+
+class StackSnapshots:
+    def __init__(self, aws_clients):
+        self.aws_clients = aws_clients
+        self.snapshots = {}
+
+    def get(self, region_name):
+        snapshot = self.snapshots.get(region_name)
+        if snapshot is None:
+            snapshot = StackSnapshot(self.aws_clients.cloudformation(region_name))
+            self.snapshots[region_name] = snapshot
+        return snapshot
@@ -0,0 +1,57 @@
+import asyncio
+from stacklift.read_config import ConfigReader
+from stacklift.templates_config import load_templates_config
+from stacklift.global_config import GlobalConfig
+from stacklift.aws_clients import AwsClients
+from stacklift.stack_snapshot import StackSnapshots
+
+LINE_FORMAT = "{0:<24} {1:<40} {2:<16} {3:<8} {4:<36} {5}"
+
+
+class StackStatus:
+    def __init__(self, name, stack_name, region, stack_desired_state, stack):
+        self.name = name
+        self.stack_name = stack_name
+        self.region = region
+        self.stack_desired_state = stack_desired_state
+        self.stack = stack
+
+    def get_status(self):
+        return self.stack["StackStatus"] if self.stack else "NOT_FOUND"
+
+    def get_last_updated(self):
+        if not self.stack:
+            return ""
+        time = self.stack.get("LastUpdatedTime") or self.stack.get("CreationTime")
+        return "{0:%Y-%m-%d %H:%M:%S}".format(time)
+
+    def __str__(self):
+        return LINE_FORMAT.format(
+            self.name, self.stack_name, self.region, self.stack_desired_state.value,
+            self.get_status(), self.get_last_updated())
+
+
+async def collect_stack_statuses(config_file, group_name, stack_snapshots):
+    templates_config = load_templates_config(GlobalConfig(config_file).get_templates_path())
+    config_reader = ConfigReader(config_file)
+
+    async def get_status(name):
+        region = config_reader.get_value(name, "Region")
+        stack_name = config_reader.get_value(name, "StackName")
+        stack = await stack_snapshots.get(region).get(stack_name)
+        template_config = templates_config.get_template_config(group_name, name)
+        return StackStatus(name, stack_name, region, template_config.get_stack_desired_state(), stack)
+
+    names = templates_config.get_group_template_names(group_name)
+    return await asyncio.gather(*[get_status(name) for name in names])
+
+
+def stack_status(config_file, group_name):
+    stack_snapshots = StackSnapshots(AwsClients())
+    loop = asyncio.get_event_loop()
+    statuses = loop.run_until_complete(collect_stack_statuses(config_file, group_name, stack_snapshots))
+
+    print(LINE_FORMAT.format(
+        "Name", "StackName", "Region", "Desired", "Status", "LastUpdated"))
+    for status in statuses:
+        print(status)
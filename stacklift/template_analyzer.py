@@ -0,0 +1,162 @@
+import os
+import json
+import threading
+import yaml
+from collections import OrderedDict
+from stacklift.read_config import ordered_loader
+
+SAFE_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+
+class TemplateParameter:
+    def __init__(self, all, required):
+        self.all = all
+        self.required = required
+
+
+def construct_cfn_tag(loader, tag_suffix, node):
+    key = tag_suffix if tag_suffix in ("Ref", "Condition") else "Fn::{}".format(tag_suffix)
+    if isinstance(node, yaml.ScalarNode):
+        value = loader.construct_scalar(node)
+        if tag_suffix == "GetAtt":
+            value = value.split(".", 1)
+    elif isinstance(node, yaml.SequenceNode):
+        value = loader.construct_sequence(node, deep=True)
+    else:
+        value = OrderedDict(loader.construct_pairs(node, deep=True))
+    return {key: value}
+
+
+class CloudFormationLoader(ordered_loader(SAFE_LOADER, OrderedDict)):
+    pass
+
+
+CloudFormationLoader.add_multi_constructor("!", construct_cfn_tag)
+
+
+def load_template(body):
+    """Load a JSON or YAML template, expanding short-form intrinsic tags such as !Ref."""
+    if body.lstrip().startswith("{"):
+        return json.loads(body, object_pairs_hook=OrderedDict)
+    return yaml.load(body, CloudFormationLoader)
+
+
+def get_template_parameter(template):
+    parameters = (template or {}).get("Parameters") or {}
+
+    all = []
+    requires = []
+    for key in parameters:
+        all.append(key)
+
+        if "Default" not in parameters[key]:
+            requires.append(key)
+
+    return TemplateParameter(all, requires)
+
+
+NULL_SCALARS = ("", "~", "null", "Null", "NULL")
+
+
+class UnsupportedSection(Exception):
+    pass
+
+
+def skip_node(events, event):
+    depth = 1 if isinstance(event, (yaml.MappingStartEvent, yaml.SequenceStartEvent)) else 0
+    while depth:
+        event = next(events)
+        if isinstance(event, (yaml.MappingStartEvent, yaml.SequenceStartEvent)):
+            depth += 1
+        elif isinstance(event, (yaml.MappingEndEvent, yaml.SequenceEndEvent)):
+            depth -= 1
+
+
+def next_key(events):
+    """Key of the next mapping entry, or None at the end of the mapping."""
+    event = next(events)
+    if isinstance(event, yaml.MappingEndEvent):
+        return None
+    if not isinstance(event, yaml.ScalarEvent) or event.value == "<<":
+        raise UnsupportedSection()
+    return event.value
+
+
+def scan_parameter_section(events):
+    event = next(events)
+    if isinstance(event, yaml.ScalarEvent) and event.implicit[0] and event.value in NULL_SCALARS:
+        return TemplateParameter([], [])
+    if not isinstance(event, yaml.MappingStartEvent):
+        raise UnsupportedSection()
+
+    all = []
+    requires = []
+    while True:
+        name = next_key(events)
+        if name is None:
+            return TemplateParameter(all, requires)
+        if not isinstance(next(events), yaml.MappingStartEvent):
+            raise UnsupportedSection()
+
+        has_default = False
+        while True:
+            key = next_key(events)
+            if key is None:
+                break
+            has_default = has_default or key == "Default"
+            skip_node(events, next(events))
+
+        all.append(name)
+        if not has_default:
+            requires.append(name)
+
+
+def scan_template_parameter(stream):
+    """TemplateParameter of a YAML or JSON template, read as a stream of parser events.
+
+    Nothing is constructed, so short-form tags need no handling, and the stream
+    is only read up to the end of the top-level Parameters mapping. Raises
+    UnsupportedSection when the section uses anchors, merge keys or other forms
+    only a full load can interpret.
+    """
+    events = yaml.parse(stream, SAFE_LOADER)
+    for event in events:
+        if isinstance(event, yaml.MappingStartEvent):
+            break
+        if isinstance(event, (yaml.ScalarEvent, yaml.SequenceStartEvent, yaml.AliasEvent)):
+            raise UnsupportedSection()
+    else:
+        return TemplateParameter([], [])
+
+    while True:
+        key = next_key(events)
+        if key is None:
+            return TemplateParameter([], [])
+        if key == "Parameters":
+            return scan_parameter_section(events)
+        skip_node(events, next(events))
+
+
+_template_parameters = {}
+_template_parameters_lock = threading.Lock()
+
+
+def analyze_template(path):
+    """Return the TemplateParameter of a template file, memoized by the file's stat signature."""
+    st = os.stat(path)
+    key = (os.path.abspath(path), st.st_ino, st.st_mtime_ns, st.st_size)
+
+    with _template_parameters_lock:
+        cached = _template_parameters.get(key)
+    if cached:
+        return cached
+
+    with open(path, "rb") as f:
+        try:
+            template_parameter = scan_template_parameter(f)
+        except (UnsupportedSection, yaml.YAMLError):
+            f.seek(0)
+            template_parameter = get_template_parameter(load_template(f.read().decode("utf-8")))
+    with _template_parameters_lock:
+        _template_parameters[key] = template_parameter
+    return template_parameter
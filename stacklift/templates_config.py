@@ -1,6 +1,9 @@
 import yaml
 import os
+import threading
+from collections import OrderedDict
 from enum import Enum, unique
+from stacklift.dependency_graph import DependencyGraph
 
 
 @unique
@@ -36,9 +39,13 @@ class TemplateConfig:
 class TemplatesConfig:
     def __init__(self, templates_config_path):
         with open(templates_config_path) as f:
-            self.templates_config = yaml.safe_load(f)
+            self.templates_config = yaml.load(f, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
         self.templates_file_dir = os.path.dirname(templates_config_path)
 
+        # built per group on first use, so that one broken group does not affect the others
+        self.group_template_configs = {}
+        self.dependency_graphs = {}
+
     def get_group_names(self):
         return self.templates_config["Groups"].keys()
 
@@ -48,19 +55,47 @@ class TemplatesConfig:
             raise RuntimeError("Group {} is not defined.".format(group_name))
         return group
 
-    def get_templates_dict(self, group_name):
-        group = self.get_group(group_name)
-        return {template["Name"]: template for template in group["Templates"]}
+    def get_group_template_configs(self, group_name):
+        if group_name not in self.group_template_configs:
+            template_configs = OrderedDict()
+            for template in self.get_group(group_name)["Templates"]:
+                name = template["Name"]
+                if name in template_configs:
+                    raise RuntimeError("Template {} is defined twice in group {}.".format(name, group_name))
+                template_configs[name] = TemplateConfig(self.templates_file_dir, template)
+            self.group_template_configs[group_name] = template_configs
+        return self.group_template_configs[group_name]
 
     def get_template_config(self, group_name, template_name):
-        template_dict = self.get_templates_dict(group_name)
-
-        template = template_dict.get(template_name)
+        template = self.get_group_template_configs(group_name).get(template_name)
         if not template:
             raise RuntimeError("Template {} is not found.".format(template_name))
 
-        return TemplateConfig(self.templates_file_dir, template)
+        return template
 
     def get_group_template_names(self, group_name):
-        template_dict = self.get_templates_dict(group_name)
-        return template_dict.keys()
+        return self.get_group_template_configs(group_name).keys()
+
+    def get_dependency_graph(self, group_name):
+        if group_name not in self.dependency_graphs:
+            self.dependency_graphs[group_name] = DependencyGraph(OrderedDict(
+                (name, x.get_depends()) for name, x in self.get_group_template_configs(group_name).items()))
+        return self.dependency_graphs[group_name]
+
+
+_templates_config_cache = {}
+_templates_config_cache_lock = threading.Lock()
+
+
+def load_templates_config(filename):
+    """Parse a templates manifest once per process, the way load_config does for configs."""
+    path = os.path.abspath(filename)
+    mtime = os.stat(path).st_mtime_ns
+    with _templates_config_cache_lock:
+        cached = _templates_config_cache.get(path)
+        if cached and cached[0] == mtime:
+            return cached[1]
+
+        templates_config = TemplatesConfig(path)
+        _templates_config_cache[path] = (mtime, templates_config)
+        return templates_config
@@ -1,12 +1,35 @@
-import boto3
+from stacklift.aws_clients import AwsClients
+from stacklift.function_archive import file_sha256
+from stacklift.s3_transfer import DEFAULT_PART_SIZE, upload_file_multipart
 from urllib.parse import urlparse
+import botocore
+import logging
 
+logger = logging.getLogger(__name__)
 
-def upload_archive(archive_url, archive_path):
+DIGEST_METADATA_KEY = "sha256"
+
+
+def get_uploaded_digest(s3, bucket, key):
+    try:
+        return s3.head_object(Bucket=bucket, Key=key).get("Metadata", {}).get(DIGEST_METADATA_KEY)
+    except botocore.exceptions.ClientError as ex:
+        if ex.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+            return None
+        raise
+
+
+def upload_archive(archive_url, archive_path, aws_clients=None, part_size=DEFAULT_PART_SIZE):
     url = urlparse(archive_url)
     if url.scheme != "s3":
         raise RuntimeError("Now upload_archive can only upload to s3")
 
-    s3 = boto3.client('s3')
-    with open(archive_path, "rb") as fp:
-        s3.put_object(Bucket=url.netloc, Key=url.path.lstrip("/"), Body=fp)
+    s3 = (aws_clients or AwsClients()).s3()
+    bucket, key = url.netloc, url.path.lstrip("/")
+    digest = file_sha256(archive_path)
+    if get_uploaded_digest(s3, bucket, key) == digest:
+        logger.info("{} is already up to date".format(archive_url))
+        return
+
+    upload_file_multipart(s3, bucket, key, archive_path, metadata={DIGEST_METADATA_KEY: digest},
+                          part_size=part_size)
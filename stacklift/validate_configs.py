@@ -1,9 +1,18 @@
 #!/usr/bin/env python3
 
-import re
-from stacklift.templates_config import TemplatesConfig, StackDesiredState
-from stacklift.read_config import yaml_ordered_load
+from stacklift.templates_config import load_templates_config, StackDesiredState
+from stacklift.read_config import load_config
+from stacklift.template_analyzer import TemplateParameter, analyze_template
 from stacklift.global_config import GlobalConfig
+from stacklift.function_archive import file_sha256
+from stacklift.local_state import default_cache_dir, load_json, save_json
+from concurrent.futures import ProcessPoolExecutor
+import os
+import sys
+import json
+import time
+import hashlib
+import functools
 
 ALL_KEYS = ["StackName",
             "Region",
@@ -17,48 +26,61 @@ REQUIRED_KEYS = ["StackName",
                  "Region"]
 
 
-class TemplateParameter:
-    def __init__(self, all, required):
-        self.all = all
-        self.required = required
-
-
 def parse_template(path):
-    with open(path) as f:
-        body = f.read()
-        before_resources = re.sub('^(Resources|Conditions):.*', '', body, flags=(re.MULTILINE | re.DOTALL))
-        template = yaml_ordered_load(before_resources)
-
-    if "Parameters" not in template:
-        return TemplateParameter([], [])
-
-    parameters = template["Parameters"]
+    return analyze_template(path)
 
-    all = []
-    requires = []
-    for key in parameters:
-        all.append(key)
 
-        if "Default" not in parameters[key]:
-            requires.append(key)
+def get_template_paths(config_path, override_module_dir, validator):
+    """Template path of every template the config can refer to; None for deleted ones.
 
-    return TemplateParameter(all, requires)
-
-
-def parse_templates(config_path, override_module_dir):
+    Broken groups of the templates manifest are reported to the validator.
+    """
     global_config = GlobalConfig(config_path)
     templates_config_path = global_config.get_templates_path(override_module_dir)
-    templates_config = TemplatesConfig(templates_config_path)
+    templates_config = load_templates_config(templates_config_path)
 
-    template_parameters = {}
+    template_paths = {}
     for group_name in templates_config.get_group_names():
-        for name in templates_config.get_group_template_names(group_name):
+        try:
+            names = templates_config.get_group_template_names(group_name)
+        except RuntimeError as ex:
+            validator.add_error(config_path, group_name, str(ex))
+            continue
+
+        try:
+            templates_config.get_dependency_graph(group_name)
+        except RuntimeError as ex:
+            validator.add_error(config_path, group_name, str(ex))
+
+        for name in names:
             template_config = templates_config.get_template_config(group_name, name)
             if template_config.get_stack_desired_state() == StackDesiredState.DELETED:
-                template_parameters[name] = TemplateParameter([], [])
+                template_paths[name] = None
             else:
-                template_parameters[name] = parse_template(template_config.get_template_path())
-    return template_parameters
+                template_paths[name] = template_config.get_template_path()
+    return template_paths
+
+
+def get_template_parameters(template_paths, parsed):
+    return {name: parsed[path] if path else TemplateParameter([], []) for name, path in template_paths.items()}
+
+
+@functools.lru_cache()
+def get_package_version():
+    # imported here, as only validation needs it (importlib.metadata is Python 3.8+)
+    try:
+        from importlib import metadata
+    except ImportError:
+        metadata = None
+    if metadata:
+        try:
+            return metadata.version("stacklift")
+        except metadata.PackageNotFoundError:
+            pass
+
+    # running from a source checkout
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "VERSION")) as f:
+        return f.read().split("\n")[0]
 
 
 def is_list_ordered(all_list, actual_list):
@@ -70,18 +92,19 @@ def is_list_ordered(all_list, actual_list):
 class Validator:
     def __init__(self):
         self.error_count = 0
+        self.errors = []
 
     def add_error(self, config_path, section_name, message):
-        print("%s:%s: %s" % (config_path, section_name, message))
+        # the config path is left out so that cached errors are printed with the path given in each run
+        self.errors.append((section_name, message))
         self.error_count += 1
 
     def validate_config(self, config_path, template_parameters):
-        with open(config_path) as f:
-            config = yaml_ordered_load(f)
+        config = load_config(config_path)
         common = config.get("Common") or {}
 
         # TODO: create test
-        for k in set(common.keys()) - set(ALL_KEYS):
+        for k in sorted(set(common.keys()) - set(ALL_KEYS), key=str):
             self.add_error(config_path, "Common", "Key '{}' is not supported".format(k))
 
         for k in [k for k in common if not isinstance(common[k], str)]:
@@ -97,7 +120,7 @@ class Validator:
                 continue
 
             section = sections[section_name]
-            for k in (set(section.keys()) - set(ALL_KEYS)):
+            for k in sorted(set(section.keys()) - set(ALL_KEYS), key=str):
                 self.add_error(config_path, section_name, "Key '{}' is not supported".format(k))
 
             for k in [k for k in section if k != "Parameters" and not isinstance(section[k], str)]:
@@ -110,26 +133,190 @@ class Validator:
             merged.update(section)
             section_params = merged.get("Parameters") or {}
 
-            for k in (set(REQUIRED_KEYS) - merged.keys()):
+            for k in sorted(set(REQUIRED_KEYS) - merged.keys(), key=str):
                 self.add_error(config_path, section_name, "Key '{}' is required".format(k))
 
             template_parameter = template_parameters[section_name]
-            for k in set(template_parameter.required) - set(section_params.keys()):
+            for k in sorted(set(template_parameter.required) - set(section_params.keys()), key=str):
                 self.add_error(config_path, section_name, "Parameter '{}' is required".format(k))
 
-            for k in set(section_params.keys()) - set(template_parameter.all):
+            for k in sorted(set(section_params.keys()) - set(template_parameter.all), key=str):
                 self.add_error(config_path, section_name, "Parameter '{}' is not supported".format(k))
 
             if not is_list_ordered(template_parameter.all, section_params.keys()):
                 self.add_error(config_path, section_name, "Parameters must be ordered: {}".format(", ".join(template_parameter.all)))
 
 
-def validate_configs(override_module_dir, config_files):
+def validate_config_errors(config_path, template_parameters):
     validator = Validator()
+    validator.validate_config(config_path, template_parameters)
+    return validator.errors
+
+
+def map_jobs(executor, func, *iterables):
+    if executor is None:
+        return list(map(func, *iterables))
+    return list(executor.map(func, *iterables))
+
+
+class ValidationCache:
+    """Validation results kept between runs.
+
+    Errors are stored per config file together with a key made of the stacklift
+    version and the digests of the config, its templates manifest and every
+    template it refers to, and parsed template parameters are stored by template
+    digest.
+    """
+
+    def __init__(self, cache_dir=None):
+        self.path = os.path.join(cache_dir or default_cache_dir(), "validation-cache.json")
+        value = load_json(self.path)
+        self.templates = value.get("templates", {})
+        self.configs = value.get("configs", {})
+
+    def get_key(self, config_path, override_module_dir, template_paths, digests):
+        templates_path = GlobalConfig(config_path).get_templates_path(override_module_dir)
+        inputs = {
+            "version": get_package_version(),
+            "config": file_sha256(config_path),
+            "templates_config": file_sha256(templates_path),
+            "templates": {name: digests.get(path) for name, path in template_paths.items()},
+        }
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+    def get_errors(self, config_path, key):
+        entry = self.configs.get(os.path.abspath(config_path))
+        return entry["errors"] if entry and entry["key"] == key else None
+
+    def set_errors(self, config_path, key, errors, template_digests):
+        self.configs[os.path.abspath(config_path)] = {"key": key, "errors": errors, "templates": template_digests}
+
+    def get_template_parameter(self, digest):
+        value = self.templates.get(digest)
+        return TemplateParameter(value["all"], value["required"]) if value else None
+
+    def set_template_parameter(self, digest, template_parameter):
+        self.templates[digest] = {"all": template_parameter.all, "required": template_parameter.required}
+
+    def save(self):
+        # merge with the file so that validations of other configs are kept
+        value = load_json(self.path)
+        configs = value.get("configs", {})
+        configs.update(self.configs)
+        templates = value.get("templates", {})
+        templates.update(self.templates)
+
+        used = set(digest for entry in configs.values() for digest in entry["templates"])
+        save_json(self.path, {"configs": configs,
+                              "templates": {k: v for k, v in templates.items() if k in used}})
+
+
+def collect_errors(override_module_dir, config_files, cache, max_workers=None):
+    """Errors of every config in input order, and the configs that actually had to be validated."""
+    template_paths = []
+    template_errors = []
     for config_path in config_files:
-        template_parameters = parse_templates(config_path, override_module_dir)
-        validator.validate_config(config_path, template_parameters)
-
-    print("%d error(s)." % (validator.error_count))
-    if validator.error_count > 0:
+        validator = Validator()
+        try:
+            template_paths.append(get_template_paths(config_path, override_module_dir, validator))
+        except RuntimeError as ex:
+            validator.add_error(config_path, "Global", str(ex))
+            template_paths.append(None)
+        template_errors.append(validator.errors)
+
+    paths = set(path for x in template_paths if x for path in x.values() if path)
+    digests = {path: file_sha256(path) for path in paths}
+    keys = [cache.get_key(config_path, override_module_dir, x, digests) if x is not None else None
+            for config_path, x in zip(config_files, template_paths)]
+    # a config whose templates manifest cannot be read is not validated any further
+    pending = [i for i, config_path in enumerate(config_files)
+               if keys[i] is not None and cache.get_errors(config_path, keys[i]) is None]
+
+    # most configs share their templates, so each distinct template content is parsed once
+    unparsed = {}
+    for i in pending:
+        for path in sorted(x for x in template_paths[i].values() if x):
+            if cache.get_template_parameter(digests[path]) is None:
+                unparsed.setdefault(digests[path], path)
+
+    executor = None
+    if max_workers != 1 and (len(pending) > 1 or len(unparsed) > 1):
+        executor = ProcessPoolExecutor(max_workers=max_workers)
+    try:
+        for digest, template_parameter in zip(unparsed, map_jobs(executor, parse_template, unparsed.values())):
+            cache.set_template_parameter(digest, template_parameter)
+
+        parsed = {path: cache.get_template_parameter(digests[path]) for path in paths}
+        results = map_jobs(executor, validate_config_errors,
+                           [config_files[i] for i in pending],
+                           [get_template_parameters(template_paths[i], parsed) for i in pending])
+    finally:
+        if executor:
+            executor.shutdown()
+
+    for i, errors in zip(pending, results):
+        cache.set_errors(config_files[i], keys[i], errors,
+                         sorted(set(digests[x] for x in template_paths[i].values() if x)))
+
+    errors = ["%s:%s: %s" % (config_path, section_name, message)
+              for config_path, key, x in zip(config_files, keys, template_errors)
+              for section_name, message in x + (cache.get_errors(config_path, key) if key is not None else [])]
+    return errors, [config_files[i] for i in pending]
+
+
+def get_watched_files(override_module_dir, config_files):
+    files = set(config_files)
+    for config_path in config_files:
+        try:
+            files.add(GlobalConfig(config_path).get_templates_path(override_module_dir))
+            files.update(x for x in get_template_paths(config_path, override_module_dir, Validator()).values() if x)
+        except Exception:
+            # the broken config is reported by the validation itself
+            pass
+    return files
+
+
+def get_mtimes(files):
+    mtimes = {}
+    for path in files:
+        try:
+            mtimes[path] = os.stat(path).st_mtime_ns
+        except OSError:
+            mtimes[path] = None
+    return mtimes
+
+
+def watch_configs(override_module_dir, config_files, max_workers=None, interval=1.0):
+    cache = ValidationCache()
+    files = None
+    mtimes = None
+    while True:
+        if files is None or get_mtimes(files) != mtimes:
+            files = get_watched_files(override_module_dir, config_files)
+            mtimes = get_mtimes(files)
+            try:
+                errors, validated = collect_errors(override_module_dir, config_files, cache, max_workers)
+                cache.save()
+                for error in errors:
+                    print(error)
+                print("%d error(s). (%d of %d config(s) validated)" % (len(errors), len(validated), len(config_files)))
+            except Exception as ex:
+                print("Failed to validate: {}".format(ex))
+            sys.stdout.flush()
+        time.sleep(interval)
+
+
+def validate_configs(override_module_dir, config_files, max_workers=None, watch=False):
+    if watch:
+        watch_configs(override_module_dir, config_files, max_workers)
+        return
+
+    cache = ValidationCache()
+    errors, _ = collect_errors(override_module_dir, config_files, cache, max_workers)
+    cache.save()
+
+    for error in errors:
+        print(error)
+    print("%d error(s)." % (len(errors)))
+    if errors:
         exit(1)